@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Datafile layout: memory used by the entries and size of the datafile, with the previous layout
+# (object strings, uncompressed 'table') against the compact one (categoricals, compressed).
+#
+#   python benchmarks/datafile_layout.py [--entries 100000 1000000] [--folders 5000]
+
+import os
+import time
+import argparse
+import tempfile
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from photnon import storage
+
+def synthetic_entries(entries, folders, seed=0):
+  ''' Entries spread over 'folders' folders, with a handful of camera models and mime types '''
+  rng = np.random.default_rng(seed)
+  cameras = [('Canon', 'Canon EOS 5D'), ('NIKON CORPORATION', 'NIKON D750'), ('Apple', 'iPhone 12'), (None, None)]
+  mimes = ['image/jpeg', 'image/heic', 'video/mp4', 'image/png']
+  folder_names = ['/Volumes/photos/{:04d}/album_{:05d}'.format(2000 + i % 20, i) for i in range(folders)]
+  camera = rng.integers(0, len(cameras), size=entries)
+  times = pd.to_datetime('2010-01-01') + pd.to_timedelta(rng.integers(0, 10**9, size=entries), unit='s')
+
+  return pd.DataFrame({
+    'folder': np.array(folder_names, dtype=object)[rng.integers(0, folders, size=entries)],
+    'name': pd.Series(np.arange(entries)).map('IMG_{:07d}.JPG'.format).values,
+    'datetime': times,
+    'make': [cameras[c][0] for c in camera],
+    'model': [cameras[c][1] for c in camera],
+    'digest': [hashlib.sha1(i.to_bytes(8, 'little')).hexdigest() for i in range(entries)],
+    'mime': np.array(mimes, dtype=object)[rng.integers(0, len(mimes), size=entries)],
+    'code': 0,
+    'size': rng.integers(10**5, 10**7, size=entries),
+    'atime': times, 'mtime': times, 'ctime': times,
+    'has_json': rng.random(size=entries) < 0.1,
+    'inode': np.arange(entries),
+    'timeless': False,
+  })
+
+def write_legacy(entries, datafilename):
+  entries.to_hdf(datafilename, key='ok', format="table")
+
+def write_compact(entries, datafilename):
+  storage.write_table(entries, datafilename, 'ok')
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="datafile layout benchmark")
+  parser.add_argument('--entries', type=int, nargs='+', default=[10000, 100000])
+  parser.add_argument('--folders', type=int, default=5000)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tempdir:
+    for entries in args.entries:
+      photos_df = synthetic_entries(entries, min(args.folders, entries))
+      memory = photos_df.memory_usage(deep=True).sum()
+      compact_memory = storage.compact(photos_df.copy()).memory_usage(deep=True).sum()
+      print("{:>8} entries: memory {:8.1f} MB -> {:8.1f} MB ({:4.1f}x)".format(
+        entries, memory / 2**20, compact_memory / 2**20, memory / compact_memory))
+
+      for label, write in [('legacy', write_legacy), ('compact', write_compact)]:
+        datafilename = os.path.join(tempdir, "{}_{}.pho".format(label, entries))
+        start = time.perf_counter()
+        write(photos_df, datafilename)
+        write_time = time.perf_counter() - start
+        start = time.perf_counter()
+        pd.read_hdf(datafilename, key='ok')
+        read_time = time.perf_counter() - start
+        print("{:>8} entries: {:8} datafile {:8.1f} MB / write {:6.2f} s / read {:6.2f} s".format(
+          entries, label, os.path.getsize(datafilename) / 2**20, write_time, read_time))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Duplicate resolution in 'generate_dupes_info': group-wise engine against the previous row-wise 'apply'.
+# Both run on the same synthetic duplicate sets, and their decisions are compared.
+#
+#   python benchmarks/dedup_engine.py [--entries 20000] [--preferred /photos/b]
+
+import time
+import argparse
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+
+from photnon.data_analysis import generate_dupes_info, REMOVAL_CODE_IGNORE, PERSIST_VERSION_KEEP
+
+def synthetic_duplicates(entries, seed=0):
+  '''
+  Digest groups of 2 to 5 entries, mixing groups with identical names/mtimes, identical mtimes (some names sharing their
+  stem) and different mtimes (some of them equal). Entries are shuffled, as groups are not contiguous in datafiles.
+  '''
+  rng = np.random.default_rng(seed)
+  group_sizes = rng.integers(2, 6, size=entries // 3)
+  digests = np.repeat(["{:040x}".format(i) for i in range(len(group_sizes))], group_sizes)
+  total = len(digests)
+  kind = np.repeat(rng.integers(0, 3, size=len(group_sizes)), group_sizes)
+
+  names = np.where(kind == 0, 'IMG_0001.JPG',
+                   pd.Series(rng.integers(0, 10, size=total)).map('IMG_{:04d}'.format).values +
+                   rng.choice(['.JPG', '.jpg', '.jpeg'], size=total))
+  mtimes = pd.to_datetime('2015-01-01') + pd.to_timedelta(np.where(kind == 2, rng.integers(0, 4, size=total), 0), unit='s')
+  folders = pd.Series(rng.integers(0, 4, size=total)).map('/photos/{}'.format).str.replace('0', 'a').str.replace('1', 'b').values
+
+  photos_df = pd.DataFrame({'folder': folders, 'name': names, 'digest': digests, 'mtime': mtimes})
+  return photos_df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+def run(photos_df, preferred_folder, groupwise):
+  photos_df = photos_df.copy()
+  photos_df['should_remove'] = REMOVAL_CODE_IGNORE
+  photos_df['persist_version'] = PERSIST_VERSION_KEEP
+  dup_digest = photos_df.duplicated(subset=['digest'], keep=False)
+  start = time.perf_counter()
+  with contextlib.redirect_stderr(io.StringIO()):
+    generate_dupes_info(photos_df, dup_digest, preferred_folder, groupwise=groupwise)
+  return time.perf_counter() - start, photos_df[['persist_version', 'should_remove']]
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="duplicate resolution benchmark")
+  parser.add_argument('--entries', type=int, nargs='+', default=[1000, 5000, 20000])
+  parser.add_argument('--preferred', default='/photos/b')
+  args = parser.parse_args()
+
+  for entries in args.entries:
+    photos_df = synthetic_duplicates(entries)
+    for preferred_folder in [False, args.preferred]:
+      rowwise_time, rowwise = run(photos_df, preferred_folder, groupwise=False)
+      groupwise_time, groupwise = run(photos_df, preferred_folder, groupwise=True)
+      print("{:>7} entries, preferred {:10}: row-wise {:8.3f} s / group-wise {:8.3f} s ({:6.1f}x) / same decisions: {}".format(
+        len(photos_df), str(preferred_folder), rowwise_time, groupwise_time, rowwise_time / groupwise_time,
+        rowwise.astype('int64').equals(groupwise.astype('int64'))))
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# Folder statistics offered by 'select_preferred_folder': prefix tree against the previous level-by-level
+# aggregation with DataFrame queries, on synthetic folder trees. Both (and the check that their results match)
+# are in 'tests/test_folders.py'.
+#
+#   python benchmarks/folder_counts.py [--folders 50 200 500]
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+from photnon.folders import collapsed_folder_counts
+from test_folders import legacy_counts, synthetic_folders
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="folder statistics benchmark")
+  parser.add_argument('--folders', type=int, nargs='+', default=[50, 200, 500])
+  args = parser.parse_args()
+
+  for size in args.folders:
+    folders = synthetic_folders(size)
+    start = time.perf_counter()
+    legacy = legacy_counts(folders)
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    trie = collapsed_folder_counts(folders)
+    trie_time = time.perf_counter() - start
+    print("{:>6} folders ({:>7} files): level queries {:8.3f} s / prefix tree {:8.3f} s ({:7.1f}x)".format(
+      folders.nunique(), len(folders), legacy_time, trie_time, legacy_time / trie_time))
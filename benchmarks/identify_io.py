@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Bytes read per file by 'identify_file', against the previous approach (streamed digest,
+# then 'magic.from_file', then 'piexif.load(path)' and 'createParser(path)' as fallback).
+#
+# read() bytes are taken from /proc/self/io ('rchar', Linux only), which also accounts for the reads
+# done by libmagic. Memory mapped files are accounted by their size, as every page is read once.
+#
+#   python benchmarks/identify_io.py <folder> [<folder> ...]
+
+import os
+import time
+import hashlib
+import argparse
+
+import magic
+import piexif
+from hachoir.parser import createParser
+
+from photnon import data_extraction
+
+def read_chars():
+  with open('/proc/self/io') as f:
+    for line in f:
+      if line.startswith('rchar:'):
+        return int(line.split()[1])
+
+def previous_identify(path):
+  digester = hashlib.sha1()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(data_extraction.CHUNK_SIZE), b''):
+      digester.update(chunk)
+  magic.from_file(path, mime=True)
+  if os.stat(path).st_size == 0:
+    return
+  try:
+    piexif.load(path)
+  except piexif._exceptions.InvalidImageDataError:
+    parser = createParser(path)
+    if parser:
+      parser.stream._input.close()
+
+def single_read_identify(path):
+  data_extraction.identify_file(path, os.path.basename(path))
+
+def measure(function, paths, mapped):
+  start_chars = read_chars()
+  start_time = time.perf_counter()
+  for path in paths:
+    try:
+      function(path)
+    except Exception:
+      # Broken files fail the same way on both approaches
+      pass
+  elapsed = time.perf_counter() - start_time
+  read_bytes = read_chars() - start_chars
+  if mapped:
+    read_bytes += sum(os.stat(path).st_size for path in paths)
+  return read_bytes, elapsed
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="identify_file I/O benchmark")
+  parser.add_argument('folders', nargs='+')
+  args = parser.parse_args()
+
+  paths = []
+  for folder in args.folders:
+    paths.extend(os.path.join(p, file) for p, file, _ in data_extraction.scan(folder))
+  total_size = sum(os.stat(path).st_size for path in paths)
+  print("{} files, {} bytes".format(len(paths), total_size))
+
+  results = {}
+  for label, function, mapped in [('previous', previous_identify, False), ('single read', single_read_identify, True)]:
+    # A first pass warms up the page cache, so both approaches are measured under the same conditions
+    measure(function, paths, mapped)
+    results[label] = measure(function, paths, mapped)
+    print("{:12}: {:>14} bytes read ({:.2f}x file size) in {:.3f} s".format(
+      label, results[label][0], results[label][0] / max(total_size, 1), results[label][1]))
+
+  print("reduction   : {:.2f}x".format(results['previous'][0] / max(results['single read'][0], 1)))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Out-of-core analysis: peak memory and time of 'bin/photnon --partitions' against the in-memory analysis,
+# both run (as separate processes) on the same synthetic datafile, and their decisions compared.
+#
+#   python benchmarks/partitioned_analysis.py [--entries 1000000] [--duplicates 0.2] [--partitions 16 64] [--jobs 1]
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from photnon import storage
+from datafile_layout import synthetic_entries
+
+PHOTNON = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'photnon')
+
+def synthetic_datafile(datafilename, entries, duplicates, seed=0):
+  ''' A datafile where a share of the entries are copies (same digest and size) of others, in other folders, and 1% are errors '''
+  rng = np.random.default_rng(seed)
+  photos_df = synthetic_entries(entries, max(entries // 200, 1), seed=seed)
+  copies = rng.choice(entries, size=int(entries * duplicates), replace=False)
+  originals = rng.integers(0, entries, size=len(copies))
+  photos_df.loc[copies, ['digest', 'size']] = photos_df.loc[originals, ['digest', 'size']].values
+  photos_df['size'] = photos_df['size'].astype('int64')
+  photos_df['phash'] = None
+  errors = rng.random(size=entries) < 0.01
+  ph_error = photos_df[errors].drop(columns='timeless').assign(code=1, datetime=None)
+  storage.write_table(photos_df[~errors], datafilename, 'ok')
+  storage.write_table(ph_error, datafilename, 'error')
+  storage.versioned(pd.DataFrame({'wd': ['.'], 'hostname': [os.uname()[1]]})).to_hdf(datafilename, key='info', format="table")
+
+def run(arguments, cwd):
+  ''' Runs photnon, returning its time and peak memory (MB) '''
+  start = time.perf_counter()
+  with open(os.devnull, 'w') as devnull:
+    process = subprocess.Popen([sys.executable, PHOTNON] + arguments, cwd=cwd, stdout=devnull, stderr=devnull)
+    _, status, usage = os.wait4(process.pid, 0)
+  if status != 0:
+    raise RuntimeError("photnon {} failed".format(' '.join(arguments)))
+  return time.perf_counter() - start, usage.ru_maxrss / 1024
+
+def decisions(datafilename):
+  return pd.read_hdf(datafilename, 'ok')[['should_remove', 'persist_version']].sort_index()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="out-of-core analysis benchmark")
+  parser.add_argument('--entries', type=int, default=1000000)
+  parser.add_argument('--duplicates', type=float, default=0.2)
+  parser.add_argument('--partitions', type=int, nargs='+', default=[16, 64])
+  parser.add_argument('--jobs', type=int, default=1)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tempdir:
+    datafilename = os.path.join(tempdir, 'library.pho')
+    # Generated by another process: the peak memory of this one would be inherited by the runs (through exec)
+    generator = multiprocessing.get_context('spawn').Process(target=synthetic_datafile, args=(datafilename, args.entries, args.duplicates))
+    generator.start()
+    generator.join()
+    print("{} entries ({:.0%} copies): datafile {:.1f} MB".format(args.entries, args.duplicates, os.path.getsize(datafilename) / 2**20))
+
+    # Outputs are only compared once all runs are done (as reading them grows this process, see above)
+    reference = os.path.join(tempdir, 'in_memory.pho')
+    elapsed, peak = run(['-d', datafilename, '-o', reference, '-r'], tempdir)
+    print("in-memory        : {:8.1f} s, peak {:8.1f} MB".format(elapsed, peak))
+
+    outputs = []
+    for partitions in args.partitions:
+      output = os.path.join(tempdir, 'partitioned_{}.pho'.format(partitions))
+      elapsed, peak = run(['-d', datafilename, '-o', output, '-r', '--partitions', str(partitions), '-j', str(args.jobs)], tempdir)
+      print("{:>4} partitions    : {:8.1f} s, peak {:8.1f} MB".format(partitions, elapsed, peak))
+      outputs.append((partitions, output))
+
+    expected = decisions(reference)
+    for partitions, output in outputs:
+      print("{:>4} partitions    : same decisions as in-memory: {}".format(partitions, decisions(output).equals(expected)))
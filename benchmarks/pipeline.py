@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Timings of every step of photnon over a synthetic library (see 'synthetic_library.py'):
+# extraction, datafile reading, enrich, deduplication and the generation of the scripts.
+# Results are written as JSON, to track them across versions.
+#
+#   python benchmarks/pipeline.py [--files 1000] [--jobs 1] [--repeat 3] [--output results.json]
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import datetime
+from importlib import metadata
+
+import pandas as pd
+
+from photnon.data_extraction import extract_data
+from photnon.data_analysis import read_datafiles, enrich, deduplication_process, produce_dupes_scripts, produce_retime_script, DIVERGENT_COLUMNS
+
+from synthetic_library import generate_library
+
+def timed(function, repeat=1):
+  ''' Best time of 'repeat' runs (photnon output is discarded), and the result of the last one '''
+  best = None
+  for _ in range(repeat):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+      start = time.perf_counter()
+      result = function()
+      elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best, result
+
+def duplicate_masks(photos_df):
+  ''' Same duplicate masks as 'bin/photnon' '''
+  dup_full = photos_df.duplicated(keep=False, subset=photos_df.columns[1:].drop(DIVERGENT_COLUMNS, errors='ignore'))
+  list_digest = photos_df.digest.value_counts()
+  dup_digest = photos_df.digest.isin(list_digest[list_digest > 1].index.values)
+  return dup_full, dup_digest
+
+def deduplicate(ph_ok, ph_error, working_info):
+  for label, photos_df in [("OK", ph_ok), ("ERROR", ph_error)]:
+    if len(photos_df) == 0:
+      continue
+    dup_full, dup_digest = duplicate_masks(photos_df)
+    deduplication_process(photos_df, dup_full, dup_digest, None, label=label, working_info=working_info)
+
+def run(library, jobs=1, repeat=1):
+  working_info = { 'wd': [os.getcwd()], 'hostname': [os.uname()[1]] }
+  results = {}
+
+  results['extract_data'], _ = timed(lambda: extract_data([library], 'library', working_info=dict(working_info), force=True, jobs=jobs), repeat)
+  results['read_datafiles'], (ph_working_info, ph_ok, ph_error, _, _) = timed(lambda: read_datafiles(working_info, ['library']), repeat)
+  results['enrich'], _ = timed(lambda: enrich(ph_ok.copy()), repeat)
+  enrich(ph_ok)
+
+  analysed = {}
+  def analyse():
+    analysed['ok'], analysed['error'] = ph_ok.copy(), ph_error.copy()
+    deduplicate(analysed['ok'], analysed['error'], ph_working_info)
+  results['deduplication_process'], _ = timed(analyse, repeat)
+
+  dup_digest = duplicate_masks(analysed['ok'])[1]
+  for manifest in [False, True]:
+    key = 'produce_dupes_scripts' + ('_manifest' if manifest else '')
+    results[key], _ = timed(lambda: produce_dupes_scripts(analysed['ok'], dup_digest, ph_working_info, label='OK', manifest=manifest), repeat)
+    key = 'produce_retime_script' + ('_manifest' if manifest else '')
+    results[key], _ = timed(lambda: produce_retime_script(analysed['ok'], script="retime.sh", manifest=manifest), repeat)
+
+  return results
+
+def version():
+  try:
+    return metadata.version('photnon')
+  except metadata.PackageNotFoundError:
+    return None
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="photnon pipeline benchmark")
+  parser.add_argument('--files', type=int, default=1000)
+  parser.add_argument('--duplicates', type=float, default=0.1)
+  parser.add_argument('--size', type=int, default=2**16, help='mean file size (bytes)')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--jobs', type=int, default=1)
+  parser.add_argument('--repeat', type=int, default=1, help='runs per step (the best one is kept)')
+  parser.add_argument('--output', help='JSON file to write the results to (otherwise, standard output)')
+  args = parser.parse_args()
+
+  output = os.path.abspath(args.output) if args.output else None
+  with tempfile.TemporaryDirectory() as tempdir:
+    library = os.path.join(tempdir, 'library')
+    generate_library(library, files=args.files, duplicates=args.duplicates, size=args.size, seed=args.seed)
+    # Datafiles and scripts are written to the working directory
+    os.chdir(tempdir)
+    results = run(library, jobs=args.jobs, repeat=args.repeat)
+
+  report = {
+    'date': datetime.datetime.now().isoformat(timespec='seconds'),
+    'photnon': version(),
+    'python': platform.python_version(),
+    'pandas': pd.__version__,
+    'platform': platform.platform(),
+    'parameters': {'files': args.files, 'duplicates': args.duplicates, 'size': args.size, 'seed': args.seed,
+                   'jobs': args.jobs, 'repeat': args.repeat},
+    'seconds': results,
+  }
+  if output:
+    with open(output, 'w') as f:
+      json.dump(report, f, indent=2)
+  else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
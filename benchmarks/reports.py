@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Report statistics: vectorized passes of 'stats' (through 'general_info', 'timed_info' and 'preduplication_info')
+# against the previous reports (kept below), which counted boolean Series with the builtin 'sum' and filtered
+# the same entries again for every figure. Both run on the same synthetic entries.
+#
+#   python benchmarks/reports.py [--rows 100000 1000000]
+
+import os
+import time
+import argparse
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+from photnon.data_analysis import general_info, timed_info, preduplication_info
+
+def legacy_general_info(ph_ok, ph_error):
+  num_ok = len(ph_ok)
+  num_error = len(ph_error)
+  num_total = num_ok + num_error
+  print("processing   : {} (ok: {}/ error: {})".format(num_total, num_ok, num_error))
+  print("% errors: {:.2%}".format(num_error/ num_total))
+  print("% with JSON metadata: {:.2%}, {}".format((sum(ph_ok.has_json)+sum(ph_error.has_json))/ num_total, sum(ph_ok.has_json)))
+
+def legacy_timed_info(photos_df_timed):
+  print("% matching times / dates: {:.2%} / {:.2%}".format(
+            sum(photos_df_timed.mtime == photos_df_timed.datetime)/len(photos_df_timed),
+            sum(photos_df_timed.mtime_date == photos_df_timed.datetime_date)/len(photos_df_timed)))
+  photos_df_timed_not = photos_df_timed[photos_df_timed.second_discrepancy != 0]
+  if len(photos_df_timed_not) > 0:
+    print("% with discrepancy ({}): {:.2%} {:.2%} {:.2%} {:.2%}".format(len(photos_df_timed_not),
+              sum(photos_df_timed_not.second_discrepancy <= 60)/len(photos_df_timed_not),
+              sum(photos_df_timed_not.second_discrepancy.between(61, 3600))/len(photos_df_timed_not),
+              sum(photos_df_timed_not.second_discrepancy.between(3601, 24*3600))/len(photos_df_timed_not),
+              sum(photos_df_timed_not.second_discrepancy > 24*3600)/len(photos_df_timed_not)))
+  print("% timeless: {:.2%}".format(len(photos_df_timed[photos_df_timed.timeless])/len(photos_df_timed)))
+  if len(photos_df_timed[photos_df_timed.timeless]) > 0:
+    print("% with discrepancy (timeless): {:.2%} {:.2%} {:.2%} {:.2%}".format(
+              sum(photos_df_timed[photos_df_timed.timeless].second_discrepancy <= 60)/len(photos_df_timed[photos_df_timed.timeless]),
+              sum(photos_df_timed[photos_df_timed.timeless].second_discrepancy.between(61, 3600))/len(photos_df_timed[photos_df_timed.timeless]),
+              sum(photos_df_timed[photos_df_timed.timeless].second_discrepancy.between(3601, 24*3600))/len(photos_df_timed[photos_df_timed.timeless]),
+              sum(photos_df_timed[photos_df_timed.timeless].second_discrepancy > 24*3600 )/len(photos_df_timed[photos_df_timed.timeless])))
+
+def legacy_preduplication_info(photos_df, dup_full, dup_full_except_first, dup_digest, dup_digest_except_first):
+  for duplicated, except_first in [(dup_full, dup_full_except_first), (dup_digest, dup_digest_except_first)]:
+    if sum(duplicated) != 0:
+      print("{} (removing {} and processing {})".format(sum(~except_first), sum(except_first), sum(duplicated)))
+      print("{} (removing {} and processing {})".format(photos_df[~except_first]['size'].sum(),
+              photos_df[except_first]['size'].sum(), photos_df[duplicated]['size'].sum()))
+
+def synthetic_entries(rows, seed=0):
+  ''' Entries as 'enrich' leaves them, with a share of retimed files, timeless dates and duplicates '''
+  rng = np.random.default_rng(seed)
+  datetimes = pd.Timestamp('2005-01-01') + pd.to_timedelta(rng.integers(0, 15 * 365 * 24 * 3600, rows), unit='s')
+  offsets = np.where(rng.random(rows) < 0.3, rng.exponential(3 * 24 * 3600, rows), 0)
+  photos_df = pd.DataFrame({'datetime': datetimes,
+                            'mtime': datetimes + pd.to_timedelta(offsets, unit='s'),
+                            'size': rng.integers(0, 2**24, rows),
+                            'has_json': rng.random(rows) < 0.1,
+                            'timeless': rng.random(rows) < 0.05,
+                            'digest': rng.integers(0, int(rows * 0.9), rows).astype(str)})
+  photos_df['mtime_date'] = photos_df.mtime.dt.date
+  photos_df['datetime_date'] = photos_df.datetime.dt.date
+  photos_df['second_discrepancy'] = (photos_df.datetime - photos_df.mtime).abs().dt.total_seconds()
+  return photos_df
+
+def timed(function, *arguments):
+  with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+    start = time.perf_counter()
+    function(*arguments)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="report statistics benchmark")
+  parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+  args = parser.parse_args()
+
+  for rows in args.rows:
+    photos_df = synthetic_entries(rows)
+    errors = photos_df.iloc[:rows // 20]
+    dup_digest = photos_df.digest.duplicated(keep=False)
+    dup_digest_except_first = photos_df.digest.duplicated(keep='first')
+    masks = (dup_digest, dup_digest_except_first, dup_digest, dup_digest_except_first)
+
+    for name, legacy, current, arguments in [('general_info', legacy_general_info, general_info, (photos_df, errors)),
+                                             ('timed_info', legacy_timed_info, timed_info, (photos_df,)),
+                                             ('preduplication_info', legacy_preduplication_info, preduplication_info, (photos_df, *masks))]:
+      legacy_time = timed(legacy, *arguments)
+      current_time = timed(current, *arguments)
+      print("{:>8} rows {:<20}: previous {:8.3f} s / vectorized {:8.3f} s ({:7.1f}x)".format(
+        rows, name, legacy_time, current_time, legacy_time / current_time))
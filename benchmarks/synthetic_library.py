@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Synthetic photo library, to benchmark photnon reproducibly (same seed, same library).
+#
+# Files are spread over folders with dates in their names ('YYYY_MM_DD', 'YYYY/MM') or without them,
+# and mix the paths taken by the extraction:
+#   - JPEGs with EXIF (written with 'piexif'), some of them with '.json' sidecars
+#   - PNGs with a 'tIME' chunk, read through Hachoir
+#   - zero-size files
+# A share of the files are copies of others, in different folders (and sometimes with different names).
+#
+#   python benchmarks/synthetic_library.py <folder> [--files 1000] [--duplicates 0.1] [--size 65536]
+
+import os
+import json
+import zlib
+import struct
+import argparse
+import datetime
+
+import numpy as np
+import piexif
+
+LAYOUTS = ['YYYY_MM_DD', 'YYYY/MM', 'flat']
+KINDS = ['jpeg', 'png', 'empty']
+
+def jpeg_with_exif(moment, payload, make='Canon', model='Canon EOS 5D'):
+  ''' A JPEG (only markers, no image data) with its EXIF, padded with 'payload' '''
+  timestamp = moment.strftime("%Y:%m:%d %H:%M:%S")
+  exif = piexif.dump({
+    '0th': {piexif.ImageIFD.Make: make, piexif.ImageIFD.Model: model, piexif.ImageIFD.DateTime: timestamp},
+    'Exif': {piexif.ExifIFD.DateTimeOriginal: timestamp},
+  })
+  app1 = b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif
+  return b'\xff\xd8' + app1 + b'\xff\xd9' + payload
+
+def png_chunk(kind, data):
+  return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+def png_with_time(moment, payload):
+  ''' A 1x1 PNG with its modification time (which Hachoir reports as creation date), padded with 'payload' '''
+  return (b'\x89PNG\r\n\x1a\n' +
+          png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)) +
+          png_chunk(b'tIME', struct.pack('>HBBBBB', moment.year, moment.month, moment.day, moment.hour, moment.minute, moment.second)) +
+          png_chunk(b'IDAT', zlib.compress(b'\x00\x00')) +
+          png_chunk(b'tEXt', b'Comment\x00' + payload[:len(payload) // 2].hex().encode()) +
+          png_chunk(b'IEND', b''))
+
+def folder_for(moment, layout, index):
+  if layout == 'YYYY_MM_DD':
+    return moment.strftime("%Y_%m_%d")
+  if layout == 'YYYY/MM':
+    return moment.strftime("%Y{}%m".format(os.path.sep))
+  return "misc_{:03d}".format(index % 50)
+
+def generate_library(root, files=1000, duplicates=0.1, size=2**16, layouts=LAYOUTS, kinds=(0.8, 0.15, 0.05), json_ratio=0.1, seed=0):
+  ''' Creates the library under 'root'. File sizes follow an exponential distribution of mean 'size' bytes.
+  Returns the number of files created (sidecars not included).
+  '''
+  rng = np.random.default_rng(seed)
+  start = datetime.datetime(2005, 1, 1)
+  originals = int(files * (1 - duplicates))
+  created = []
+
+  for index in range(originals):
+    moment = start + datetime.timedelta(seconds=int(rng.integers(0, 15 * 365 * 24 * 3600)))
+    kind = KINDS[rng.choice(len(KINDS), p=kinds)]
+    folder = os.path.join(root, folder_for(moment, layouts[rng.integers(0, len(layouts))], index))
+    os.makedirs(folder, exist_ok=True)
+    payload = rng.bytes(int(rng.exponential(size)))
+
+    if kind == 'jpeg':
+      name, content = "IMG_{:06d}.JPG".format(index), jpeg_with_exif(moment, payload)
+    elif kind == 'png':
+      name, content = "SCR_{:06d}.png".format(index), png_with_time(moment, payload)
+    else:
+      name, content = "EMPTY_{:06d}.JPG".format(index), b''
+
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as f:
+      f.write(content)
+    os.utime(path, (moment.timestamp(), moment.timestamp()))
+    if kind == 'jpeg' and rng.random() < json_ratio:
+      with open(path + ".json", 'w') as f:
+        json.dump({'Tags': ['synthetic', str(moment.year)], 'Description': '', 'Title': name}, f)
+    created.append(path)
+
+  for index in range(files - originals):
+    original = created[rng.integers(0, originals)]
+    folder = os.path.join(root, "copies_{:02d}".format(index % 10))
+    os.makedirs(folder, exist_ok=True)
+    name = os.path.basename(original) if rng.random() < 0.5 else "copy_{:06d}_{}".format(index, os.path.basename(original))
+    path = os.path.join(folder, name)
+    with open(original, 'rb') as f, open(path, 'wb') as copy:
+      copy.write(f.read())
+    mtime = os.stat(original).st_mtime + (0 if rng.random() < 0.5 else int(rng.integers(1, 10**6)))
+    os.utime(path, (mtime, mtime))
+
+  return files
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="synthetic photo library generator")
+  parser.add_argument('root')
+  parser.add_argument('--files', type=int, default=1000)
+  parser.add_argument('--duplicates', type=float, default=0.1, help='share of files which are copies of others')
+  parser.add_argument('--size', type=int, default=2**16, help='mean file size (bytes)')
+  parser.add_argument('--layouts', nargs='+', choices=LAYOUTS, default=LAYOUTS)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  count = generate_library(args.root, files=args.files, duplicates=args.duplicates, size=args.size, layouts=args.layouts, seed=args.seed)
+  print("{} files created under '{}'".format(count, args.root))
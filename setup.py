@@ -31,6 +31,9 @@ setuptools.setup(
           'hachoir',
           'tqdm'
       ],
+    extras_require={
+          'similar': ['Pillow'],
+      },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
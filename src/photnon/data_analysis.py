@@ -1,5 +1,6 @@
 import os
 import re
+import json
 from jinja2 import Environment,PackageLoader
 template_env = Environment(
     loader=PackageLoader('photnon', 'templates')
@@ -11,6 +12,10 @@ template_env.filters['pathjoin'] = lambda *paths: os.path.join(*paths)
 
 
 from photnon import storage
+from photnon import digests
+from photnon import profiling
+from photnon import similarity
+from photnon import stats
 
 import pandas as pd
 from tqdm import tqdm
@@ -31,6 +36,9 @@ REMOVAL_CODE_LEGEND = { REMOVAL_CODE_IGNORE: "Ignore",
 
 PERSIST_VERSION_KEEP = -1
 
+# Values which might differ without impacting file identity (some are computed)
+DIVERGENT_COLUMNS = ['atime', 'ctime', 'inode', 'phash', 'should_remove', 'persist_version']
+
 LOG_PROGRESS_THRESHOLD = 2000
 
 def bsize_value(value):
@@ -130,11 +138,87 @@ def decide_removal_action(x, preferred_candidates, decide_removal_entries):
     # Either there is no alternative or right now there is only one: this entry
     return {'persist_version': PERSIST_VERSION_KEEP, 'should_remove':REMOVAL_CODE_POSIBLE}
 
-def generate_dupes_info(photos_df, dup_indexes, preferred_folder = False, verbose=0):
-  if len(photos_df[dup_indexes]) == 0:
-    return
-
-  if verbose >= 1: print("{}Remove pre-report{}".format(Fore.GREEN,Fore.RESET))
+def best_alternatives(candidates):
+  '''
+  Group-wise equivalent of 'select_best_alternative_index' for every digest in 'candidates' (which have 'digest', 'name',
+  'mtime' and 'index' columns, the entries of every digest in the order 'select_best_alternative_index' gets them),
+  returned as a Series of 'index' by digest.
+  Where the best alternative is tied with another one, the (unstable) sorts of 'select_best_alternative_index' decide:
+  those groups go through it, so that the same entry is chosen.
+  '''
+  groups = candidates.groupby('digest', sort=False)
+  digest_info = pd.DataFrame({'size': groups.size(),
+                              'num_name': groups['name'].nunique(dropna=False),
+                              'num_mtime': groups['mtime'].nunique(dropna=False)})
+  by_position = (digest_info['size'] == 1) | ((digest_info['num_name'] == 1) & (digest_info['num_mtime'] == 1))
+  by_name = ~by_position & (digest_info['num_mtime'] == 1)
+  by_mtime = ~by_position & ~by_name
+
+  criteria = candidates.digest.map(pd.Series('position', index=digest_info.index)
+                                     .mask(by_name, 'name')
+                                     .mask(by_mtime, 'mtime'))
+  best = []
+  tied = []
+  for criterion in ['position', 'name', 'mtime']:
+    criterion_candidates = candidates[criteria == criterion]
+    if len(criterion_candidates) == 0:
+      continue
+    if criterion == 'position':
+      best.append(criterion_candidates.drop_duplicates('digest', keep='first'))
+      continue
+    if criterion == 'name':
+      key = criterion_candidates['name'].astype(object).str.split('.', n=1).str[0]
+    else:
+      key = criterion_candidates['mtime']
+    is_lowest = key == key.groupby(criterion_candidates['digest']).transform('min')
+    num_lowest = is_lowest.groupby(criterion_candidates['digest']).transform('sum')
+    best.append(criterion_candidates[is_lowest & (num_lowest == 1)])
+    if (num_lowest > 1).any():
+      tied.append(criterion_candidates[num_lowest > 1])
+
+  if len(best) == 0:
+    return pd.Series(dtype='int64')
+  best = pd.concat(best)
+  best = pd.Series(best['index'].values, index=best['digest'].values)
+  if len(tied) > 0:
+    tied = pd.concat(tied)
+    best = pd.concat([best, tied.groupby('digest', sort=False).apply(select_best_alternative_index)])
+  return best
+
+def decide_removal_groupwise(decide_removal_entries, preferred, order=None):
+  '''
+  Group-wise equivalent of applying 'decide_removal_action' to every entry, computing the master of each digest group once.
+  'preferred' flags the entries in the preferred folder: if a group has any, the master is chosen among them.
+  'order' is the 'lookup_order' of the entries (computed from them if None).
+  Returns 'persist_version' and 'should_remove' for every entry.
+  '''
+  if order is None:
+    order = lookup_order(decide_removal_entries['digest'])
+  candidates = pd.DataFrame({'digest': decide_removal_entries['digest'].values,
+                             'name': decide_removal_entries['name'].values,
+                             'mtime': decide_removal_entries['mtime'].values,
+                             'index': decide_removal_entries.index.values,
+                             'preferred': preferred.values})
+  num_preferred = candidates.groupby('digest', sort=False)['preferred'].transform('sum')
+  # The alternatives of every digest in the order 'decide_removal_action' looks them up: sorted by digest,
+  # but preferred candidates in their own order
+  candidates['order'] = order.reindex(decide_removal_entries.index).values
+  candidates['order'] = candidates['order'].where(num_preferred == 0, candidates.index.values)
+  candidates = candidates[(num_preferred == 0) | candidates['preferred']].sort_values('order', kind='mergesort')
+
+  master = decide_removal_entries['digest'].map(best_alternatives(candidates))
+  num_preferred = preferred.groupby(decide_removal_entries['digest']).transform('sum')
+  is_master = master == decide_removal_entries.index
+
+  decisions = pd.DataFrame({'persist_version': master.where(~is_master, PERSIST_VERSION_KEEP),
+                            'should_remove': REMOVAL_CODE_SCHEDULE}, index=decide_removal_entries.index)
+  decisions.loc[is_master, 'should_remove'] = REMOVAL_CODE_POSIBLE
+  # A single preferred entry is not just the best alternative, but the one to keep
+  decisions.loc[is_master & (num_preferred == 1), 'should_remove'] = REMOVAL_CODE_KEEP
+  return decisions.astype('int64')
+
+def dupes_candidates(photos_df, dup_indexes, verbose=0):
+  ''' The entries of 'dup_indexes' which 'generate_dupes_info' decides on '''
   # All that shouldn't be removed yet (and therefore susceptible of analysis)
   photos_df_dups = photos_df.loc[dup_indexes][photos_df.loc[dup_indexes].should_remove != REMOVAL_CODE_SCHEDULE]
   list_digest = photos_df_dups.digest.value_counts()
@@ -150,6 +234,28 @@ def generate_dupes_info(photos_df, dup_indexes, preferred_folder = False, verbos
                           len(photos_df_dups),
                           len(photos_df_dups) - len(list_digest_dup)
                         ))
+  return photos_df_dups
+
+def lookup_order(digests):
+  '''
+  Position of every entry ('digests' of the entries of 'dupes_candidates') once sorted by digest, as they are when
+  'decide_removal_action' looks up the alternatives of an entry. The sort is not stable: equal digests end up in an
+  order which depends on all the digests sorted.
+  '''
+  by_digest = pd.DataFrame({'digest': digests.values, 'index': digests.index.values}).set_index('digest', drop=False).sort_index()
+  return pd.Series(range(len(by_digest)), index=by_digest['index'].values)
+
+def generate_dupes_info(photos_df, dup_indexes, preferred_folder = False, groupwise=True, order=None, verbose=0):
+  '''
+  With 'groupwise' (the default) the removal decisions are computed for all digest groups at once,
+  instead of entry by entry through 'decide_removal_action'.
+  'order' is the 'lookup_order' of the entries, when only some of the entries decided on are in 'photos_df'.
+  '''
+  if len(photos_df[dup_indexes]) == 0:
+    return
+
+  if verbose >= 1: print("{}Remove pre-report{}".format(Fore.GREEN,Fore.RESET))
+  photos_df_dups = dupes_candidates(photos_df, dup_indexes, verbose=verbose)
 
   # Preserve 'preferred folder'. This doesn't work when duplicates are on the same one
   if preferred_folder:
@@ -163,16 +269,21 @@ def generate_dupes_info(photos_df, dup_indexes, preferred_folder = False, verbos
   photos_df.loc[photos_df_dups.index, 'should_remove'] = REMOVAL_CODE_POSIBLE
 
   decide_removal_entries = photos_df.loc[photos_df_dups.index]
-  if len(decide_removal_entries) > LOG_PROGRESS_THRESHOLD:
-    decide_removal = decide_removal_entries.progress_apply
+  if groupwise:
+    preferred = decide_removal_entries.index.isin(preferred_candidates['index']) if preferred_candidates is not None else False
+    photos_df.loc[photos_df_dups.index, ['persist_version', 'should_remove']] = decide_removal_groupwise(
+          decide_removal_entries, pd.Series(preferred, index=decide_removal_entries.index), order=order)
   else:
-    decide_removal = decide_removal_entries.apply
+    if len(decide_removal_entries) > LOG_PROGRESS_THRESHOLD:
+      decide_removal = decide_removal_entries.progress_apply
+    else:
+      decide_removal = decide_removal_entries.apply
 
-  # Sorting the index makes the ,loc somewhat faster (2x-3x)
-  decide_removal_entries = decide_removal_entries.reset_index().set_index('digest',drop=False).sort_index()
-  photos_df.loc[photos_df_dups.index, ['persist_version', 'should_remove']] = decide_removal(
-          lambda x: decide_removal_action(x, preferred_candidates, decide_removal_entries),
-          axis=1, result_type='expand')
+    # Sorting the index makes the ,loc somewhat faster (2x-3x)
+    decide_removal_entries = decide_removal_entries.reset_index().set_index('digest',drop=False).sort_index()
+    photos_df.loc[photos_df_dups.index, ['persist_version', 'should_remove']] = decide_removal(
+            lambda x: decide_removal_action(x, preferred_candidates, decide_removal_entries),
+            axis=1, result_type='expand')
 
   # Once all content duplicates have been identified and tagged for removal, let's double check we are not doing anything stupid
   # This block guarantees that all refered masters (persist_version) are kept.
@@ -180,19 +291,57 @@ def generate_dupes_info(photos_df, dup_indexes, preferred_folder = False, verbos
   # The scenario is when there are two sets of name duplicates which ALSO match digests
   # By the time digests are processed, there would be to-be-removed entries used as reference for already-pending-removal entries
   all_replaceable = photos_df.loc[photos_df[photos_df.persist_version != PERSIST_VERSION_KEEP].index]
-  if any(all_replaceable.persist_version.isin(all_replaceable.index)):
+  replaceable_masters = all_replaceable.persist_version.isin(all_replaceable.index)
+  if replaceable_masters.any():
     print("{}some master files are also replaceable. fixing".format(Fore.YELLOW))
-    new_persist_version = all_replaceable[all_replaceable.persist_version.isin(all_replaceable.index)].apply(
-      lambda x: all_replaceable.loc[x.persist_version].persist_version,
-      axis=1 )
+    new_persist_version = all_replaceable.loc[replaceable_masters, 'persist_version'].map(all_replaceable.persist_version)
     all_replaceable.loc[new_persist_version.index, 'persist_version'] = new_persist_version.values
+    photos_df.loc[new_persist_version.index, 'persist_version'] = new_persist_version.values
 
   all_persisted_version_kept = all(photos_df.loc[all_replaceable.persist_version].persist_version == PERSIST_VERSION_KEEP)
   if not all_persisted_version_kept:
     raise Exception("Some file intented as a master are to be removed!")
 
       
-def produce_dupes_scripts(photos_df, dup_indexes, working_info = None, label=None):
+def fullpaths(photos_df):
+  ''' Vectorised 'os.path.join' of 'folder' and 'name' '''
+  folders = photos_df['folder'].astype(object)
+  separators = pd.Series(os.path.sep, index=photos_df.index).where(~(folders.str.endswith(os.path.sep) | (folders == '')), '')
+  return folders + separators + photos_df['name']
+
+def write_dupes_manifest(grouped_entries, manifest):
+  '''
+  Writes one JSON line per digest group: { "digest": ..., "entries": [ {"path", "name", "has_json", "keep"}, ... ] }
+  'grouped_entries' must be sorted so the entries of each digest are together.
+  '''
+  count = 0
+  with open(manifest, 'w') as f:
+    digest, entries = None, []
+    for entry_digest, path, name, has_json, persist_version in zip(grouped_entries['digest'], grouped_entries['fullpath'],
+            grouped_entries['name'], grouped_entries['has_json'], grouped_entries['persist_version']):
+      if entry_digest != digest:
+        if digest is not None:
+          f.write(json.dumps({'digest': digest, 'entries': entries}) + "\n")
+          count += 1
+        digest, entries = entry_digest, []
+      entries.append({'path': path, 'name': name, 'has_json': bool(has_json), 'keep': bool(persist_version == PERSIST_VERSION_KEEP)})
+    if digest is not None:
+      f.write(json.dumps({'digest': digest, 'entries': entries}) + "\n")
+      count += 1
+  return count
+
+def dupes_manifest_entries(photos_df, dup_indexes):
+  ''' The entries of the digest groups with a kept master, sorted by digest (as 'write_dupes_manifest' needs them) '''
+  dups = photos_df.loc[dup_indexes]
+  kept_digests = dups[dups['persist_version'] == PERSIST_VERSION_KEEP].digest
+  entries = dups[dups['digest'].isin(kept_digests)][['folder', 'name', 'digest', 'has_json', 'persist_version']]
+  return entries.assign(fullpath=fullpaths(entries)).sort_values('digest', kind='mergesort')
+
+def produce_dupes_scripts(photos_df, dup_indexes, working_info = None, label=None, manifest=False):
+  '''
+  With 'manifest', the digest groups are written as JSON Lines to 'dedup_<label>.jsonl', and 'dedup_<label>.sh' is a fixed
+  script processing them. Otherwise the script has the processing of every group written out.
+  '''
   script_parts = []
   '''
   if [[ $(hostname) != 'Wintermute-Manoeuvre.local' ]]; then
@@ -245,16 +394,24 @@ def produce_dupes_scripts(photos_df, dup_indexes, working_info = None, label=Non
   #  print(json_digest)
 
   photos_dfa = photos_df[['folder', 'name', 'digest', 'has_json', 'persist_version']].copy()
-  photos_dfa['fullpath'] = photos_dfa.apply(lambda x: os.path.join(x['folder'], x['name']), axis=1)
-
-  template = template_env.get_template('dedup')
-  #print(template.render(entries=photos_df[photos_df['should_remove'] != REMOVAL_CODE_SCHEDULE]))
-  grouped = photos_dfa.loc[dup_indexes][photos_dfa.loc[dup_indexes, 'digest'].isin(kept_digests)].groupby('digest')
+  photos_dfa['fullpath'] = fullpaths(photos_dfa)
 
   script_hostname = ''
   if working_info is not None:
     script_hostname = working_info.hostname[0]
 
+  if manifest:
+    manifest_name = "dedup_{}.jsonl".format(label)
+    write_dupes_manifest(dupes_manifest_entries(photos_dfa, dup_indexes), manifest_name)
+    template_env.get_template('dedup_runner').stream(manifest = manifest_name,
+                  script_hostname = script_hostname).dump("dedup_{}.sh".format(label))
+    os.chmod("dedup_{}.sh".format(label), 0o755)
+    return
+
+  template = template_env.get_template('dedup')
+  #print(template.render(entries=photos_df[photos_df['should_remove'] != REMOVAL_CODE_SCHEDULE]))
+  grouped = photos_dfa.loc[dup_indexes][photos_dfa.loc[dup_indexes, 'digest'].isin(kept_digests)].groupby('digest')
+
   template.stream(digest_groups = grouped,
                   script_hostname = script_hostname,
                   KEPT_MARK=PERSIST_VERSION_KEEP).dump("dedup_{}.sh".format(label))
@@ -263,8 +420,39 @@ def produce_dupes_scripts(photos_df, dup_indexes, working_info = None, label=Non
   #print(photos_df.loc[dup_indexes][photos_df.loc[dup_indexes, 'should_remove'] == REMOVAL_CODE_SCHEDULE].digest)
   #print(photos_df[photos_df.digest =='8475834aeda8bb5907c2da3b085017b172213ce8'])
 
-def produce_retime_script(photos_df, script="retime.sh"):
-  ''' A pure python implementation is slower than 'touch' when executed file by file.
+def write_retime_manifest(timestamps, paths, manifest):
+  ''' Writes one JSON line per file: [timestamp, path], with the timestamp in 'touch -t' format '''
+  count = 0
+  with open(manifest, 'w') as f:
+    for timestamp, path in zip(timestamps, paths):
+      f.write(json.dumps([timestamp, path]) + "\n")
+      count += 1
+  return count
+
+def retime_entries(photos_df, tolerance=None, skip_timeless=False):
+  '''
+  Entries to retime: all of those not scheduled for removal or, with a 'tolerance' (in seconds), only
+  those whose mtime is further than that from their datetime (the 'second_discrepancy' from 'enrich').
+  With 'skip_timeless', entries whose datetime has no time information are left as they are.
+  '''
+  retimeable = photos_df['should_remove'] != REMOVAL_CODE_SCHEDULE
+  if tolerance is not None:
+    discrepancy = photos_df['second_discrepancy'] if 'second_discrepancy' in photos_df.columns else \
+                  (photos_df.datetime - photos_df.mtime).abs().dt.total_seconds()
+    retimeable &= ~(discrepancy <= tolerance)
+  if skip_timeless and 'timeless' in photos_df.columns:
+    retimeable &= ~photos_df['timeless'].fillna(False).astype(bool)
+  return photos_df[retimeable]
+
+def produce_retime_script(photos_df, script="retime.sh", manifest=False, tolerance=None, skip_timeless=False):
+  '''
+  With 'tolerance' and 'skip_timeless', only the entries needing it are retimed (see 'retime_entries'), so
+  files already matching don't get their metadata rewritten (and their ctime changed).
+
+  With 'manifest', the (timestamp, path) pairs are also written to '<script>.jsonl', applied in batches by
+  the fixed 'retime.py' script (with os.utime, and optionally in parallel). The shell script is the portable option.
+
+  A pure python implementation is slower than 'touch' when executed file by file.
   It might be possible (and better) executing as a loop, but using python is less portable.
   In any case, a pure python version would look like this:
 
@@ -281,9 +469,21 @@ def produce_retime_script(photos_df, script="retime.sh"):
   template = template_env.get_template('retime.sh')
   #print(template.render(entries=photos_df[photos_df['should_remove'] != REMOVAL_CODE_SCHEDULE]))
 
-  photos_dfa = photos_df[['folder', 'name','datetime', 'should_remove']].copy()
-  photos_dfa['fullpath'] = photos_dfa.apply(lambda x: os.path.join(x['folder'], x['name']), axis=1)
-  template.stream(entries=photos_dfa[photos_dfa['should_remove'] != REMOVAL_CODE_SCHEDULE]).dump(script)
+  photos_dfa = retime_entries(photos_df, tolerance, skip_timeless)[['folder', 'name', 'datetime']]
+  if tolerance is not None or skip_timeless:
+    print("{} files to retime, {} skipped".format(len(photos_dfa),
+            sum(photos_df['should_remove'] != REMOVAL_CODE_SCHEDULE) - len(photos_dfa)))
+  # Timestamps and paths are built for all entries at once, instead of per entry while rendering
+  timestamps = photos_dfa['datetime'].dt.strftime("%Y%m%d%H%M.%S")
+  paths = fullpaths(photos_dfa)
+  template.stream(entries=zip(timestamps, paths)).dump(script)
+
+  if manifest:
+    manifest_name = "{}.jsonl".format(os.path.splitext(script)[0])
+    runner = os.path.join(os.path.dirname(script), "retime.py")
+    write_retime_manifest(timestamps, paths, manifest_name)
+    template_env.get_template('retime_runner').stream(manifest = os.path.basename(manifest_name)).dump(runner)
+    os.chmod(runner, 0o755)
   '''
 
   script_parts = []
@@ -296,193 +496,252 @@ def produce_retime_script(photos_df, script="retime.sh"):
       f.write(script_content)
   '''
 
+def sanitize_folders(folders, wd):
+  ''' Resolves the (possibly relative) folders against 'wd', computing the real path once per distinct folder '''
+  unique_folders = folders.unique()
+  real_folders = {f: os.path.realpath(os.path.join(wd, f)) for f in unique_folders}
+  return folders.map(real_folders)
+
+def remap_persist_versions(persist_versions, index, offset):
+  '''
+  'persist_version' references the index of the datafile the entry comes from: translate it into the positions
+  the entries will have once all datafiles are concatenated (starting at 'offset')
+  '''
+  positions = pd.Index(index).get_indexer(persist_versions)
+  return persist_versions.where(persist_versions == PERSIST_VERSION_KEEP, positions + offset)
+
 def read_datafiles(running_working_info, datafiles, deduplicate=True):
-  ph_working_info = pd.DataFrame()
-  ph_ok = pd.DataFrame()
-  ph_error = pd.DataFrame()
+  '''
+  Every datafile is opened once, and the frames from all of them are concatenated at the end.
+  '''
+  working_infos = []
+  oks = []
+  errors = []
+  num_read_ok = 0
+  num_read_error = 0
 
   for datafile in datafiles:
     last_working_info = None
-    store = pd.HDFStore(storage.normalize(datafile))
-    if '/info' in store:
-      store.close()
-      last_working_info = pd.read_hdf(storage.normalize(datafile), key='info')
-      if last_working_info.loc[0, 'hostname'] != running_working_info['hostname'][0]:
-        print("Datafile '{}{}{}' was generated at {}, but analysis is running on {}".format(
-            Fore.GREEN, datafile, Fore.RESET,
-            last_working_info.loc[0, 'hostname'], running_working_info['hostname'][0]
-          ))
-      ph_working_info = pd.concat([ph_working_info, last_working_info])
-      #print(ph_working_info)
-    else:
-      store.close()
-      print("{}Datafile '{}{}{}' doesn't contain 'info':{} be extra vigilant\n".format(Fore.RED, Fore.GREEN, datafile, Fore.RED, Fore.RESET))
-  
-    ph_ok = pd.concat([ph_ok, pd.read_hdf(storage.normalize(datafile), key='ok')])
-    ph_error = pd.concat([ph_error, pd.read_hdf(storage.normalize(datafile), key='error')])
-    if last_working_info is not None:
-      # Sanitize folders
-      wd = last_working_info.loc[0, 'wd']
-      ph_ok['folder'] = ph_ok.folder.apply(lambda x: os.path.realpath(os.path.join(wd, x)))
-      ph_error['folder'] = ph_error.folder.apply(lambda x: os.path.realpath(os.path.join(wd, x)))
-
-  # Because persist_version references indexes...
-  ph_ok.reset_index(inplace=True)
-  if 'persist_version' in ph_ok.columns:
-    map_reindex = {v:k for k,v in ph_ok['index'].to_dict().items()}
-    map_reindex[PERSIST_VERSION_KEEP] = PERSIST_VERSION_KEEP
-    ph_ok['persist_version'] = ph_ok['persist_version'].transform(lambda x: map_reindex[x])
-  ph_ok.drop('index', axis=1, inplace=True)
-  ph_error.reset_index(inplace=True)
-  if 'persist_version' in ph_error.columns:
-    map_reindex = {v:k for k,v in ph_error['index'].to_dict().items()}
-    map_reindex[PERSIST_VERSION_KEEP] = PERSIST_VERSION_KEEP
-    ph_error['persist_version'] = ph_error['persist_version'].transform(lambda x: map_reindex[x])
-  ph_error.drop('index', axis=1, inplace=True)
-
-  num_read_ok = len(ph_ok)
-  num_read_error = len(ph_error)
+    with pd.HDFStore(storage.normalize(datafile), mode='r') as store:
+      if '/info' in store:
+        last_working_info = store['info']
+        if last_working_info.loc[0, 'hostname'] != running_working_info['hostname'][0]:
+          print("Datafile '{}{}{}' was generated at {}, but analysis is running on {}".format(
+              Fore.GREEN, datafile, Fore.RESET,
+              last_working_info.loc[0, 'hostname'], running_working_info['hostname'][0]
+            ))
+        if storage.schema_version(last_working_info) > storage.SCHEMA_VERSION:
+          print("{}Datafile '{}' uses a newer schema ({}) than this version of photnon ({}){}".format(Fore.RED, datafile,
+                  storage.schema_version(last_working_info), storage.SCHEMA_VERSION, Fore.RESET))
+        working_infos.append(last_working_info)
+      else:
+        print("{}Datafile '{}{}{}' doesn't contain 'info':{} be extra vigilant\n".format(Fore.RED, Fore.GREEN, datafile, Fore.RED, Fore.RESET))
+
+      # Empty tables are not written to datafiles
+      ok = store['ok'] if '/ok' in store else pd.DataFrame()
+      error = store['error'] if '/error' in store else pd.DataFrame()
+
+    for frame, frames, offset in [(ok, oks, num_read_ok), (error, errors, num_read_error)]:
+      if last_working_info is not None and 'folder' in frame.columns:
+        # Sanitize folders
+        frame['folder'] = sanitize_folders(frame['folder'], last_working_info.loc[0, 'wd'])
+      # Because persist_version references indexes...
+      if 'persist_version' in frame.columns:
+        frame['persist_version'] = remap_persist_versions(frame['persist_version'], frame.index, offset)
+      frames.append(frame)
+    num_read_ok += len(ok)
+    num_read_error += len(error)
+
+  ph_working_info = pd.concat(working_infos) if working_infos else pd.DataFrame()
+  ph_ok = pd.concat(oks, ignore_index=True) if oks else pd.DataFrame()
+  ph_error = pd.concat(errors, ignore_index=True) if errors else pd.DataFrame()
+
+  # Digests skipped by the staged extraction might be needed now, as entries from several datafiles can collide
+  if len(datafiles) > 1:
+    if 'digest' in ph_ok.columns: ph_ok['digest'] = digests.resolve_digests(ph_ok)
+    if 'digest' in ph_error.columns: ph_error['digest'] = digests.resolve_digests(ph_error)
+
+  # Repeated strings (folders, makes, models, mime types) are kept once
+  storage.compact(ph_ok)
+  storage.compact(ph_error)
+
   if deduplicate:
     ph_ok = ph_ok.drop_duplicates(keep='first')
     ph_error = ph_error.drop_duplicates(keep='first')
   
   return ph_working_info, ph_ok, ph_error, num_read_ok, num_read_error
 
-def deduplication_process(photos_df, dup_full, dup_digest, output_script, label, working_info = None, preferred_folder=False, goal=0, verbose=0):
+def deduplication_process(photos_df, dup_full, dup_digest, output_script, label, working_info = None, preferred_folder=False, goal=0, manifest=False, verbose=0):
   # process all entries from the input
   photos_df.loc[:, 'should_remove'] = REMOVAL_CODE_IGNORE
   photos_df.loc[:, 'persist_version'] = PERSIST_VERSION_KEEP
 
   if sum(dup_full) != 0:
     print("{}   - full -{}".format(Fore.GREEN,Fore.RESET))
-    generate_dupes_info(photos_df, dup_full, preferred_folder, verbose = verbose)
+    with profiling.stage('dedup'):
+      generate_dupes_info(photos_df, dup_full, preferred_folder, verbose = verbose)
     report_dupes(photos_df, dup_full, goal, verbose = verbose)
 
   if sum(dup_digest) != 0:
     print("{}   - digest -{}".format(Fore.GREEN,Fore.RESET))
-    generate_dupes_info(photos_df, dup_digest, preferred_folder, verbose = verbose)
+    with profiling.stage('dedup'):
+      generate_dupes_info(photos_df, dup_digest, preferred_folder, verbose = verbose)
     report_dupes(photos_df, dup_digest, goal, verbose = verbose)
 
-  produce_dupes_scripts(photos_df, dup_digest, working_info, label=label)
+  with profiling.stage('render'):
+    produce_dupes_scripts(photos_df, dup_digest, working_info, label=label, manifest=manifest)
 
-def preduplication_info(photos_df, dup_full, dup_full_except_first, dup_digest, dup_digest_except_first):
-  num_photos = len(photos_df)
-  if sum(dup_full) != 0 | sum(dup_digest) != 0:
-    print("photos {}, after reducing:".format(
-        num_photos
-      ))
-  else:
-    print("photos {}".format(
-        num_photos
-      ))
+def decide_near_removal(clustered, preferred_folder=False):
+  '''
+  Master of every near duplicate cluster ('cluster' column): among the entries in the preferred folder if there are any,
+  the largest file, then the oldest one, then the first one. Other entries point to it as possible removals only, as their
+  content differs (they are to be reviewed). Masters keep their 'should_remove'.
+  Returns 'persist_version' and 'should_remove' for every entry.
+  '''
+  preferred = clustered['folder'].astype(object).str.match(preferred_folder) if preferred_folder else False
+  ranking = clustered.assign(preferred=preferred, position=range(len(clustered)))
+  ranking = ranking.sort_values(['cluster', 'preferred', 'size', 'mtime', 'position'],
+                                ascending=[True, False, False, True, True], kind='mergesort').drop_duplicates('cluster')
+  master = clustered['cluster'].map(pd.Series(ranking.index, index=ranking['cluster'].values))
+  is_master = master == clustered.index
+
+  decisions = pd.DataFrame({'persist_version': master.where(~is_master, PERSIST_VERSION_KEEP),
+                            'should_remove': REMOVAL_CODE_POSIBLE}, index=clustered.index)
+  decisions.loc[is_master, 'should_remove'] = clustered.loc[is_master, 'should_remove']
+  return decisions.astype('int64')
+
+def produce_near_dupes_script(photos_df, clustered, working_info=None, label=None, distance=similarity.DEFAULT_DISTANCE):
+  ''' Writes 'near_dupes_<label>.sh', listing every cluster for review (and removing its near duplicates when asked to) '''
+  entries = photos_df.loc[clustered.index, ['folder', 'name', 'size', 'has_json', 'phash', 'persist_version']].assign(
+              fullpath=lambda entries: fullpaths(entries), cluster=clustered['cluster'])
+  masters = entries[entries['persist_version'] == PERSIST_VERSION_KEEP].set_index('cluster')
+  master_hashes = similarity.hash_values(masters.loc[entries['cluster'], 'phash'])
+  entries['distance'] = similarity.hamming(similarity.hash_values(entries['phash']), master_hashes)
+
+  clusters = []
+  for cluster, group in entries.sort_values(['cluster', 'distance'], kind='mergesort').groupby('cluster', sort=False):
+    keep = masters.loc[cluster]
+    clusters.append({'keep': {'path': keep['fullpath'], 'size': int(keep['size'])},
+                     'entries': [{'path': path, 'size': int(size), 'has_json': bool(has_json), 'distance': int(distance)}
+                                 for path, size, has_json, distance, persist_version in zip(group['fullpath'], group['size'],
+                                       group['has_json'], group['distance'], group['persist_version'])
+                                 if persist_version != PERSIST_VERSION_KEEP]})
 
-  if sum(dup_full) != 0:
-    print("   - full   -> {} (removing {} and processing {})".format(
-      sum(~dup_full_except_first),
-      sum(dup_full_except_first),
-      sum(dup_full)
-      ))
-  if sum(dup_digest) != 0:
-    print("   - digest -> {} (removing {} and processing {})".format(
-      sum(~dup_digest_except_first),
-      sum(dup_digest_except_first),
-      sum(dup_digest)
-      ))
-
-  if 'size' in photos_df:
-    size_photos = bsize_value(photos_df['size'].sum())
-    if sum(dup_full) != 0 | sum(dup_digest) != 0:
-      print("size {:.3f} {}, after reducing:".format(
-          *size_photos
-        ))
-    else:
-      print("size {:.3f} {}".format(
-          *size_photos
-        ))
+  script_hostname = ''
+  if working_info is not None:
+    script_hostname = working_info.hostname[0]
+  script = "near_dupes_{}.sh".format(label)
+  template_env.get_template('near_dedup').stream(clusters=clusters, distance=distance,
+                  script_hostname=script_hostname).dump(script)
+  os.chmod(script, 0o755)
 
-    if sum(dup_full) != 0:
+def near_deduplication_process(photos_df, label, working_info=None, distance=similarity.DEFAULT_DISTANCE, preferred_folder=False, verbose=0):
+  '''
+  Near duplicates (see 'similarity') among the entries with a perceptual hash which are not scheduled for removal
+  (so it runs after 'deduplication_process'). They are tagged as possible removals pointing to the master of their
+  cluster, and listed in a review script.
+  '''
+  if 'phash' not in photos_df.columns:
+    return
+  hashed = photos_df['phash'].notna() & (photos_df['phash'] != similarity.NO_HASH)
+  candidates = photos_df[hashed & (photos_df['should_remove'] != REMOVAL_CODE_SCHEDULE)]
+  if len(candidates) == 0:
+    return
+
+  with profiling.stage('near_dedup'):
+    labels = pd.Series(similarity.clusters(candidates['phash'].values, distance), index=candidates.index)
+    clustered = candidates[labels >= 0].assign(cluster=labels[labels >= 0])
+    if len(clustered) == 0:
+      return
+    photos_df.loc[clustered.index, ['persist_version', 'should_remove']] = decide_near_removal(clustered, preferred_folder)
+
+  print("{}   - near ({} bits) -{}".format(Fore.GREEN, distance, Fore.RESET))
+  print("near duplicate clusters: {} / pictures: {} (out of {} with a perceptual hash)".format(
+          clustered['cluster'].nunique(), len(clustered), len(candidates)))
+
+  with profiling.stage('render'):
+    produce_near_dupes_script(photos_df, clustered, working_info, label=label, distance=distance)
+
+def preduplication_info(photos_df, dup_full, dup_full_except_first, dup_digest, dup_digest_except_first):
+  ''' Prints the duplication statistics (see 'stats.duplication_stats'), and returns them '''
+  info = stats.duplication_stats(photos_df, dup_full, dup_full_except_first, dup_digest, dup_digest_except_first)
+  full, digest = info['full'], info['digest']
+  reducing = full['processed'] != 0 or digest['processed'] != 0
+
+  print("photos {}{}".format(info['photos'], ", after reducing:" if reducing else ""))
+  if full['processed'] != 0:
+    print("   - full   -> {} (removing {} and processing {})".format(full['kept'], full['removed'], full['processed']))
+  if digest['processed'] != 0:
+    print("   - digest -> {} (removing {} and processing {})".format(digest['kept'], digest['removed'], digest['processed']))
+
+  if info['size'] is not None:
+    print("size {:.3f} {}{}".format(*bsize_value(info['size']), ", after reducing:" if reducing else ""))
+    if full['processed'] != 0:
       print("   - full   -> {:.3f} {} (removing {:.3f} {} and processing {:.3f} {})".format(
-          *bsize_value(photos_df[~dup_full_except_first]['size'].sum()),
-          *bsize_value(photos_df[dup_full_except_first]['size'].sum()),
-          *bsize_value(photos_df[dup_full]['size'].sum())
-        ))
-    if sum(dup_digest) != 0:
+          *bsize_value(full['kept_size']), *bsize_value(full['removed_size']), *bsize_value(full['processed_size'])))
+    if digest['processed'] != 0:
       print("   - digest -> {:.3f} {} (removing {:.3f} {} and processing {:.3f} {})".format(
-          *bsize_value(photos_df[~dup_digest_except_first]['size'].sum()),
-          *bsize_value(photos_df[dup_digest_except_first]['size'].sum()),
-          *bsize_value(photos_df[dup_digest]['size'].sum())
-        ))
+          *bsize_value(digest['kept_size']), *bsize_value(digest['removed_size']), *bsize_value(digest['processed_size'])))
   print()
+  return info
 
 def general_info(ph_ok, ph_error):
-  num_ok = len(ph_ok)
-  num_error = len(ph_error)
-  num_total = num_ok + num_error
-  print("processing   : {} (ok: {}/ error: {})".format(num_total, num_ok, num_error))
-  print("{}% errors{}: {:.2%}".format(Fore.GREEN, Fore.RESET, num_error/ num_total))
-  print("{}% with JSON metadata{}: {:.2%}, {}".format(Fore.GREEN, Fore.RESET, (sum(ph_ok.has_json)+sum(ph_error.has_json))/ num_total, sum(ph_ok.has_json)))
+  ''' Prints the general statistics (see 'stats.general_stats'), and returns them '''
+  return print_general_info(stats.general_stats(ph_ok, ph_error))
+
+def print_general_info(info):
+  print("processing   : {} (ok: {}/ error: {})".format(info['total'], info['ok'], info['error']))
+  if info['total'] == 0:
+    return info
+  print("{}% errors{}: {:.2%}".format(Fore.GREEN, Fore.RESET, info['errors']))
+  print("{}% with JSON metadata{}: {:.2%}, {}".format(Fore.GREEN, Fore.RESET, info['with_json'], info['with_json_ok']))
+  return info
+
+def folder_dates(folders, pattern, format):
+  ''' Parses the date in every distinct folder only once, broadcasting the result to all entries '''
+  unique_folders = pd.Series(folders.unique())
+  dates = pd.to_datetime(unique_folders.str.extract(pattern, expand=False), errors='coerce', format=format)
+  return folders.map(pd.Series(dates.values, index=unique_folders.values))
 
 def enrich(photos_df):
   '''
   The list of columns added is returned. There is no need to store those values are they'll be recreated.
   Also, they might not be storable as HDF due to the types.
   '''
-  photos_df['mtime_date'] = photos_df.mtime.apply(lambda x: x.date())
-  photos_df['datetime_date'] = photos_df.datetime.apply(lambda x: x.date())
-  photos_df['second_discrepancy'] = (photos_df.datetime - photos_df.mtime).apply(lambda x: abs(x.total_seconds()))
-  # photos_df['folder_date'] = photos_df['folder'].apply(lambda x: len(x.split('/')))
-  #photos_df['folder_date'] = photos_df['folder'].str.split('/').str[-1].str.match('\d{4}_\d{2}_\d{2}')
+  photos_df['mtime_date'] = photos_df.mtime.dt.date
+  photos_df['datetime_date'] = photos_df.datetime.dt.date
+  photos_df['second_discrepancy'] = (photos_df.datetime - photos_df.mtime).abs().dt.total_seconds()
 
-  # Up to this point, the baseline is .8459 s -> 2.106 (1.98 without bool) for the hd_bank_master.pho set / and .16045 -> 0.36 for the hd_back.pho set
-#
+  # There are way less folders than entries, so folder dates are computed per folder
   #Always a day
   a = re.compile(".*{0}(\d{{4}}_\d{{2}}_\d{{2}})(?:\s+[^{0}]*)?".format(os.path.sep))
-  #photos_df['folder_has_date'] = photos_df['folder'].str.match(a)
-  photos_df['folder_date'] = photos_df['folder'].str.extract(a)
-  photos_df['folder_date'] = pd.to_datetime(photos_df['folder_date'], errors='coerce', format='%Y_%m_%d')
+  photos_df['folder_date'] = folder_dates(photos_df['folder'], a, '%Y_%m_%d')
 
   # Months without day?
   a = re.compile(".*{0}(\d{{4}}{0}\d{{2}}){0}(?!\d{{4}}_\d{{2}}_\d{{2}})".format(os.path.sep))
-  #photos_df['folder_has_month_date'] = photos_df['folder'].str.match(a)
-  photos_df['folder_month_date'] = photos_df['folder'].str.extract(a)
-  photos_df['folder_month_date'] = pd.to_datetime(photos_df['folder_month_date'], errors='coerce', format='%Y{}%m'.format(os.path.sep))
+  photos_df['folder_month_date'] = folder_dates(photos_df['folder'], a, '%Y{}%m'.format(os.path.sep))
 
   return ['mtime_date', 'datetime_date', 'second_discrepancy',
           'folder_date', 'folder_month_date'] # Values that cannot be stored as HDF and are computable
 
 
 def timed_info(photos_df_timed):
-  print("{0}% matching times / dates{1}: {2:.2%} {0}/{1} {3:.2%}".format(Fore.GREEN,Fore.RESET,
-            sum(photos_df_timed.mtime == photos_df_timed.datetime)/len(photos_df_timed),
-            sum(photos_df_timed.mtime_date == photos_df_timed.datetime_date)/len(photos_df_timed)))
+  ''' Prints the time statistics (see 'stats.timed_stats'), and returns them '''
+  return print_timed_info(stats.timed_stats(photos_df_timed))
 
-  #print("{0}% with discrepancy{1}:{0} <1 minute:{1} {2:.2%} {0}/ <1 hour:{1} {3:.2%} {0}/ <1 day:{1} {4:.2%} {0}/ >1 day:{1} {5:.2%}".format(Fore.GREEN,Fore.RESET,
-  #          sum(photos_df_timed.second_discrepancy <= 60)/len(photos_df_timed),
-  #          sum(photos_df_timed.second_discrepancy <= 3600)/len(photos_df_timed),
-  #          sum(photos_df_timed.second_discrepancy <= 24*3600)/len(photos_df_timed),
-  #          sum(photos_df_timed.second_discrepancy > 24*3600)/len(photos_df_timed)))
+def print_timed_info(info):
+  if info['photos'] == 0:
+    return info
+  print("{0}% matching times / dates{1}: {2:.2%} {0}/{1} {3:.2%}".format(Fore.GREEN,Fore.RESET,
+            info['matching_times'], info['matching_dates']))
 
-  photos_df_timed_not = photos_df_timed[photos_df_timed.second_discrepancy != 0]
-  if len(photos_df_timed_not) > 0:
+  if info['discrepant'] > 0:
     print("{0}% with discrepancy ({1}{6}{0}):{1} {2:.2%} {0}<= 1 minute <{1} {3:.2%} {0}<= 1 hour <{1} {4:.2%} {0}<= 1 day <{1} {5:.2%}".format(Fore.GREEN,Fore.RESET,
-              sum(photos_df_timed_not.second_discrepancy <= 60)/len(photos_df_timed_not),
-              sum(photos_df_timed_not.second_discrepancy.between(61, 3600))/len(photos_df_timed_not),
-              sum(photos_df_timed_not.second_discrepancy.between(3601, 24*3600))/len(photos_df_timed_not),
-              sum(photos_df_timed_not.second_discrepancy > 24*3600)/len(photos_df_timed_not),
-              len(photos_df_timed_not)))
-
-  print("{}% timeless{}: {:.2%}".format(Fore.GREEN,Fore.RESET,
-            len(photos_df_timed[photos_df_timed.timeless])/len(photos_df_timed)))
-  #if len(photos_df_timed[photos_df_timed.timeless]) > 0:
-  #  print("{0}% with discrepancy (timeless){1}:{0} <1 minute:{1} {2:.2%} {0}/ <1 hour:{1} {3:.2%} {0}/ <1 day:{1} {4:.2%} {0}/ >1 day:{1} {5:.2%}".format(Fore.GREEN,Fore.RESET,
-  #            sum(photos_df_timed[photos_df_timed.timeless].second_discrepancy <= 60)/len(photos_df_timed[photos_df_timed.timeless]),
-  #            sum(photos_df_timed[photos_df_timed.timeless].second_discrepancy <= 3600)/len(photos_df_timed[photos_df_timed.timeless]),
-  #            sum(photos_df_timed[photos_df_timed.timeless].second_discrepancy <= 24*3600)/len(photos_df_timed[photos_df_timed.timeless]),
-  #            sum(photos_df_timed[photos_df_timed.timeless].second_discrepancy > 24*3600)/len(photos_df_timed[photos_df_timed.timeless])))
-
-  if len(photos_df_timed[photos_df_timed.timeless]) > 0:
+              *info['discrepancy'], info['discrepant']))
+
+  print("{}% timeless{}: {:.2%}".format(Fore.GREEN,Fore.RESET, info['timeless']))
+
+  if info['timeless_photos'] > 0:
     print("{0}% with discrepancy (timeless){1}: {2:.2%} {0}<= 1 minute <{1} {3:.2%} {0}<= 1 hour <{1} {4:.2%} {0}<= 1 day <{1} {5:.2%}".format(Fore.GREEN,Fore.RESET,
-              sum(photos_df_timed[photos_df_timed.timeless].second_discrepancy <= 60)/len(photos_df_timed[photos_df_timed.timeless]),
-              sum(photos_df_timed[photos_df_timed.timeless].second_discrepancy.between(61, 3600))/len(photos_df_timed[photos_df_timed.timeless]),
-              sum(photos_df_timed[photos_df_timed.timeless].second_discrepancy.between(3601, 24*3600))/len(photos_df_timed[photos_df_timed.timeless]),
-              sum(photos_df_timed[photos_df_timed.timeless].second_discrepancy > 24*3600 )/len(photos_df_timed[photos_df_timed.timeless])))
+              *info['timeless_discrepancy']))
+  return info
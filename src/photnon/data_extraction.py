@@ -1,18 +1,23 @@
 # piexif is faster than Hachoir, and so has prececence
 # Even if it cannot treat as many files, the speed gain is worthy
+# Files are sent to either from their type (see 'EXTRACTORS'), Hachoir being the fallback when piexif fails
 #
 
 import piexif
 import os
 import sys
 import hashlib
+import mmap
+import struct
+import contextlib
 from tqdm import tqdm
 
 import magic
 import re
 
 from hachoir.metadata import extractMetadata
-from hachoir.parser import createParser
+from hachoir.parser import guessParser
+from hachoir.stream import InputIOStream
 from hachoir.core import config as HachoirConfig
 HachoirConfig.quiet = True
 
@@ -20,10 +25,18 @@ from prompt_toolkit.shortcuts import confirm
 
 import glob
 import time
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, lru_cache
 import pandas as pd
 from datetime import datetime as dt
 
 from photnon import storage
+from photnon import digests
+from photnon import library
+from photnon import profiling
+from photnon import scheduler
+from photnon import similarity
 
 from colorama import init, Fore
 init(autoreset=True)
@@ -35,6 +48,41 @@ CODE_WEIRD = 3
 CODE_SIZE_ZERO = 4
 
 CHUNK_SIZE = 2**20 # 1 MB
+MAGIC_BUFFER_SIZE = 2**20 # libmagic default 'bytes_max'
+
+# Metadata-only extraction: bytes at the start of the file used for the MIME detection and the EXIF of JPEG and TIFF files,
+# and bytes Hachoir can read from containers
+METADATA_HEADER_SIZE = 2**17 # 128 kB
+METADATA_HACHOIR_LIMIT = 2**18 # 256 kB
+
+# Metadata extractors, chosen per file from its MIME type (see 'extractor_for')
+EXTRACTOR_EXIF = 'exif'
+EXTRACTOR_HACHOIR = 'hachoir'
+EXTRACTOR_SKIP = 'skip'
+
+# MIME type, or MIME type prefix ending with '/', -> (extractor, bytes it can read, seconds it can take), None being no limit
+# Files starting as JPEG, TIFF (as most RAW formats) or WebP go to piexif whatever their MIME type, and to Hachoir
+# (with the limits given) if piexif cannot read them
+EXTRACTORS = {
+  'image/jpeg': (EXTRACTOR_EXIF, 2**26, 10),
+  'image/tiff': (EXTRACTOR_EXIF, 2**26, 10),
+  'image/webp': (EXTRACTOR_EXIF, 2**26, 10),
+  'image/': (EXTRACTOR_HACHOIR, 2**26, 10),
+  'video/': (EXTRACTOR_HACHOIR, 2**26, 30),
+  'audio/': (EXTRACTOR_HACHOIR, 2**24, 10),
+  'text/': (EXTRACTOR_SKIP, None, None),
+  'application/json': (EXTRACTOR_SKIP, None, None),
+  'application/xml': (EXTRACTOR_SKIP, None, None),
+  'application/pdf': (EXTRACTOR_SKIP, None, None),
+}
+DEFAULT_EXTRACTOR = (EXTRACTOR_HACHOIR, 2**26, 30)
+
+# Streaming extraction: entries per write, and room for strings in the datafile tables (which cannot grow once created)
+STREAM_BATCH_SIZE = 5000
+STREAM_BACKLOG = 4096 # files gathered (scanned, but not identified yet) at a time
+STREAM_MIN_ITEMSIZE = {'folder': 1024, 'name': 255, 'datetime': 32, 'make': 128, 'model': 128, 'digest': 128, 'mime': 128, 'phash': 16}
+STREAM_COMPLEVEL = 5
+STREAM_COMPLIB = 'blosc'
 
 IGNORED_FOLDERS = ['.AppleDouble', '.git']
 IGNORED_FILES = ['.DS_Store', 'ZbThumbnail.info', '.gitignore']
@@ -45,9 +93,126 @@ for pat in IGNORED_PATTERNS:
   patterns.append(re.compile(pat))
 IGNORED_PATTERNS = patterns
 
+# Single regular expressions, so each directory entry is checked once
+IGNORED_FOLDERS_REGEX = re.compile("|".join("(?:{}$)".format(re.escape(ign)) for ign in IGNORED_FOLDERS))
+IGNORED_FILES_REGEX = re.compile("|".join(["(?:{}$)".format(re.escape(ign)) for ign in IGNORED_FILES] +
+                                          ["(?:{})".format(ign.pattern) for ign in IGNORED_PATTERNS]))
+
+def file_view(f, size):
+  ''' Read-only memory map of the whole file (empty files cannot be mapped) '''
+  if size == 0:
+    return contextlib.nullcontext(b'')
+  return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def jpeg_exif_segment(data):
+  ''' Finds the EXIF APP1 segment walking the JPEG markers, without copying the rest of the file '''
+  head = 2
+  while head + 4 <= len(data):
+    marker = data[head:head + 2]
+    if marker in (b"\xff\xda", b"\xff\xd9"):
+      break
+    length = struct.unpack(">H", data[head + 2:head + 4])[0]
+    if marker == b"\xff\xe1" and data[head + 4:head + 10] == b"Exif\x00\x00":
+      return data[head:head + length + 2]
+    head += length + 2
+  return None
+
+def load_exif(data):
+  ''' 'piexif.load' over the bytes of a file (as 'piexif.load' would do with its path) '''
+  if data[0:2] == b"\xff\xd8":
+    app1 = jpeg_exif_segment(data)
+    if app1 is None:
+      return {"0th": {}, "Exif": {}, "GPS": {}, "Interop": {}, "1st": {}, "thumbnail": None}
+    return piexif.load(app1[4:])
+  elif data[0:2] in (b"\x49\x49", b"\x4d\x4d") or (data[0:4] == b"RIFF" and data[8:12] == b"WEBP"):
+    # TIFF and WebP offsets can point anywhere in the file
+    return piexif.load(bytes(data))
+  raise piexif._exceptions.InvalidImageDataError("Given file is neither JPEG nor TIFF.")
+
+def load_exif_head(data, size):
+  ''' 'load_exif' over the first 'size' bytes, where the EXIF of JPEG and TIFF files usually is.
+  The whole file is used if the EXIF reaches beyond them.
+  '''
+  head = data[:size]
+  if len(head) == len(data):
+    return load_exif(head)
+  try:
+    return load_exif(head)
+  except piexif._exceptions.InvalidImageDataError:
+    raise
+  except Exception:
+    return load_exif(data)
+
+def has_exif_signature(data):
+  ''' Whether the file starts as the formats handled by 'load_exif' '''
+  return data[0:2] in (b"\xff\xd8", b"\x49\x49", b"\x4d\x4d") or (data[0:4] == b"RIFF" and data[8:12] == b"WEBP")
+
+def extractor_for(mime, data):
+  ''' Returns the (extractor, byte limit, timeout) of a file, from its first bytes and its MIME type (see 'EXTRACTORS') '''
+  if has_exif_signature(data):
+    return EXTRACTORS['image/jpeg']
+  if mime in EXTRACTORS:
+    return EXTRACTORS[mime]
+  return EXTRACTORS.get(mime.split('/')[0] + '/', DEFAULT_EXTRACTOR)
+
+@lru_cache(maxsize=1)
+def mime_detector():
+  ''' libmagic handle, shared by every file identified in the process '''
+  return magic.Magic(mime=True)
+
+class LimitExceeded(IOError):
+  pass
+
+class BoundedReader:
+  ''' File-like view of 'data' for Hachoir, failing once more than 'limit' bytes have been read
+  or 'timeout' seconds have passed (None being no limit).
+  Hachoir catches most errors while parsing, so 'exceeded' tells whether it happened.
+  '''
+  def __init__(self, data, limit=None, timeout=None):
+    self.data = data
+    self.limit = limit
+    self.deadline = time.monotonic() + timeout if timeout is not None else None
+    self.position = 0
+    self.read_bytes = 0
+    self.exceeded = None
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    self.position = offset if whence == os.SEEK_SET else (self.position + offset if whence == os.SEEK_CUR else len(self.data) + offset)
+    return self.position
+
+  def tell(self):
+    return self.position
+
+  def read(self, size=-1):
+    end = len(self.data) if size is None or size < 0 else min(len(self.data), self.position + size)
+    self.read_bytes += max(0, end - self.position)
+    if self.limit is not None and self.read_bytes > self.limit:
+      self.exceeded = "more than {} bytes read".format(self.limit)
+    elif self.deadline is not None and time.monotonic() > self.deadline:
+      self.exceeded = "timeout"
+    if self.exceeded:
+      raise LimitExceeded(self.exceeded)
+    chunk = self.data[self.position:end]
+    self.position = max(self.position, end)
+    return chunk
+
+  def close(self):
+    pass
+
 count_hachoir = 0
-def identify_file(path, name, verbose=0):
+def identify_file(path, name, verbose=0, hashing=True, stats=None, metadata_only=False, phash=False):
+  ''' Each file is read once: the same memory map feeds the digest, the MIME detection and the metadata parsers.
+  With 'hashing' disabled the digest is not computed (it is left to the staged process in 'digests')
+  Metadata are read by the extractor of the file type (see 'EXTRACTORS'), Hachoir being used as well when piexif
+  cannot read the file.
+  With 'metadata_only', the digest is not computed either, and only the start of the file is used for the MIME
+  detection and the EXIF (see 'METADATA_HEADER_SIZE'), while Hachoir can read up to 'METADATA_HACHOIR_LIMIT' bytes.
+  With 'phash', pictures get a perceptual hash as well (see 'similarity').
+  'stats' can be provided if the file was already stat'ed (i.e. while scanning)
+  '''
   global count_hachoir
+  timing = profiling.enabled
+  if timing: identifying = profiling.start('identify')
   datetime = None
   make = None
   model = None
@@ -55,168 +220,560 @@ def identify_file(path, name, verbose=0):
   mime = None
   code = CODE_OK
   has_json = False
+  perceptual_hash = None
 
-  stats = os.stat(path)
+  if stats is None:
+    stats = os.stat(path)
   atime = dt.fromtimestamp(stats.st_atime)
   mtime = dt.fromtimestamp(stats.st_mtime)
   ctime = dt.fromtimestamp(stats.st_ctime)
 
-  digester = hashlib.sha1()
-  with open(path, "rb") as f:
-    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
-      digester.update(chunk)
-  digest = digester.hexdigest()
-  mime = magic.from_file(path, mime=True)
+  with open(path, "rb") as f, file_view(f, stats.st_size) as data:
+    if hashing and not metadata_only:
+      if timing: step = profiling.start('hash')
+      digester = hashlib.sha1()
+      with memoryview(data) as view:
+        for offset in range(0, len(view), CHUNK_SIZE):
+          digester.update(view[offset:offset + CHUNK_SIZE])
+      digest = digester.hexdigest()
+      if timing:
+        profiling.stop('hash', step)
+        profiling.count('bytes_hashed', stats.st_size)
+    if timing: step = profiling.start('magic')
+    detector = mime_detector()
+    mime = detector.from_buffer(data[:METADATA_HEADER_SIZE if metadata_only else MAGIC_BUFFER_SIZE]) if stats.st_size > 0 else detector.from_file(path)
+    if timing: profiling.stop('magic', step)
 
-  if stats.st_size == 0:
-    code = CODE_SIZE_ZERO
-  else:
-    # Are there metadata as .json?
-    has_json = os.path.exists(path+'.json')
+    if stats.st_size == 0:
+      code = CODE_SIZE_ZERO
+    else:
+      # Are there metadata as .json?
+      has_json = os.path.exists(path+'.json')
 
-    try:
-      pic_exif = piexif.load(path)
-      if verbose > 4 : print(pic_exif)
-      try:
-        #36867 - taken
-        #36868 - digitized
-  
-        # datetime
-        if (36867 in pic_exif["Exif"]):
-          #and ( pic_exif["Exif"][36867] == pic_exif["Exif"][36868]):
-          datetime = pic_exif["Exif"][36867].decode('utf-8')
-          if verbose > 1 : print("{}EXIF - {}".format(Fore.BLUE, name))
-        elif 306 in pic_exif['0th']:
-          datetime = pic_exif['0th'][306].decode('utf-8')
-          if verbose > 1 : print("{}0th - {}".format(Fore.WHITE, name))
-        elif 'GPS' in pic_exif and 29 in pic_exif['GPS']:
-          datetime = pic_exif['GPS'][29].decode('utf-8')
-          if verbose > 1 : print("{}GPS - {}".format(Fore.GREEN, name))
-        else:
-          code = CODE_WEIRD
-          if verbose: print("{}ABSENT - {}".format(Fore.YELLOW, name))
-          if verbose > 2 : print(pic_exif)       
-        # make
-        if 42035 in pic_exif["Exif"]:
-          make = pic_exif["Exif"][42035].decode('utf-8')
-        elif 271 in pic_exif['0th']:
-          make = pic_exif["0th"][271].decode('utf-8')
+      extractor, byte_limit, timeout = extractor_for(mime, data)
+      if metadata_only:
+        byte_limit = METADATA_HACHOIR_LIMIT if byte_limit is None else min(byte_limit, METADATA_HACHOIR_LIMIT)
+
+      if extractor == EXTRACTOR_EXIF:
+        if timing: step = profiling.start('piexif')
+        try:
+          pic_exif = load_exif_head(data, METADATA_HEADER_SIZE) if metadata_only else load_exif(data)
+          if timing:
+            profiling.stop('piexif', step)
+            profiling.count('piexif_ok')
+          if verbose > 4 : print(pic_exif)
+          try:
+            #36867 - taken
+            #36868 - digitized
   
-        # model
-        if 42036 in pic_exif["Exif"]:
-          model = pic_exif["Exif"][42036].decode('utf-8')
-        elif 272 in pic_exif['0th']:
-          model = pic_exif["0th"][272].decode('utf-8')
+            # datetime
+            if (36867 in pic_exif["Exif"]):
+              #and ( pic_exif["Exif"][36867] == pic_exif["Exif"][36868]):
+              datetime = pic_exif["Exif"][36867].decode('utf-8')
+              if verbose > 1 : print("{}EXIF - {}".format(Fore.BLUE, name))
+            elif 306 in pic_exif['0th']:
+              datetime = pic_exif['0th'][306].decode('utf-8')
+              if verbose > 1 : print("{}0th - {}".format(Fore.WHITE, name))
+            elif 'GPS' in pic_exif and 29 in pic_exif['GPS']:
+              datetime = pic_exif['GPS'][29].decode('utf-8')
+              if verbose > 1 : print("{}GPS - {}".format(Fore.GREEN, name))
+            else:
+              code = CODE_WEIRD
+              if verbose: print("{}ABSENT - {}".format(Fore.YELLOW, name))
+              if verbose > 2 : print(pic_exif)       
+            # make
+            if 42035 in pic_exif["Exif"]:
+              make = pic_exif["Exif"][42035].decode('utf-8')
+            elif 271 in pic_exif['0th']:
+              make = pic_exif["0th"][271].decode('utf-8')
   
-      except KeyError:
-        code = CODE_ERROR
-        print("{}KEY ERROR - {}".format(Fore.RED, name))
-        if verbose > 2: print(pic_exif)
-    except piexif._exceptions.InvalidImageDataError:
-      code = CODE_INVALIDIMAGEDATA
-      if verbose: print("{}NOT an EXIF picture - {}".format(Fore.RED, name))
+            # model
+            if 42036 in pic_exif["Exif"]:
+              model = pic_exif["Exif"][42036].decode('utf-8')
+            elif 272 in pic_exif['0th']:
+              model = pic_exif["0th"][272].decode('utf-8')
   
-      parser = createParser(path)
-      #print(path)
-      if parser:
+          except KeyError:
+            code = CODE_ERROR
+            if timing: profiling.count('piexif_key_error')
+            print("{}KEY ERROR - {}".format(Fore.RED, name))
+            if verbose > 2: print(pic_exif)
+        except piexif._exceptions.InvalidImageDataError:
+          # Left to Hachoir
+          extractor = EXTRACTOR_HACHOIR
+          if timing:
+            profiling.stop('piexif', step)
+            profiling.count('piexif_invalid')
+
+      if extractor == EXTRACTOR_SKIP:
+        code = CODE_INVALIDIMAGEDATA
+        if timing: profiling.count('extractor_skipped')
+        if verbose: print("{}NOT a media file - {}".format(Fore.RED, name))
+      elif extractor == EXTRACTOR_HACHOIR:
+        code = CODE_INVALIDIMAGEDATA
+        if timing: step = profiling.start('hachoir')
+        if verbose: print("{}NOT an EXIF picture - {}".format(Fore.RED, name))
+
+        metadata = None
+        reader = BoundedReader(data, byte_limit, timeout)
         try:
-          metadata = extractMetadata(parser)
-          if metadata:
-            metadata = metadata.exportDictionary(human=False)
-  
-            if 'Metadata' in metadata:
-              datetime = metadata['Metadata']['creation_date'].replace('-', ':')
-            elif 'Common' in metadata:
-              datetime = metadata['Common']['creation_date'].replace('-', ':')
-  
-            code = CODE_OK
-            count_hachoir += 1
-            if verbose: print("   {}NOW! - {}".format(Fore.GREEN, name))
+          parser = guessParser(InputIOStream(reader, source="file:" + path, tags=[("filename", path)]))
+          #print(path)
+          if parser:
+            metadata = extractMetadata(parser)
+            if metadata:
+              metadata = metadata.exportDictionary(human=False)
+
+              if 'Metadata' in metadata:
+                datetime = metadata['Metadata']['creation_date'].replace('-', ':')
+              elif 'Common' in metadata:
+                datetime = metadata['Common']['creation_date'].replace('-', ':')
+
+              code = CODE_OK
+              count_hachoir += 1
+              if timing: profiling.count('hachoir_ok')
+              if verbose: print("   {}NOW! - {}".format(Fore.GREEN, name))
+          elif not reader.exceeded:
+            if timing: profiling.count('hachoir_no_parser')
+            if verbose: print("   {}NOT even NOW - {}".format(Fore.RED, name))
         except:
+          if timing and not reader.exceeded: profiling.count('hachoir_error')
           if verbose > 1: print("{} - {}".format(name, metadata))
+        if reader.exceeded:
+          if timing: profiling.count('hachoir_limit')
+          if verbose: print("   {}NOT even NOW ({}) - {}".format(Fore.RED, reader.exceeded, name))
+        if timing: profiling.stop('hachoir', step)
+
+      if phash and mime.startswith('image/'):
+        if timing: step = profiling.start('phash')
+        perceptual_hash = similarity.perceptual_hash(data)
+        if timing: profiling.stop('phash', step)
+
+  if timing: profiling.stop('identify', identifying, latency=True)
+  return (datetime, make, model, digest, mime, code, stats.st_size, atime, mtime, ctime, has_json, stats.st_ino, perceptual_hash)
+
+def identify_task(task, **options):
+  ''' Process pool entry point for 'identify_file'.
+  Workers have their own copy of 'count_hachoir' (and of the profiling metrics), so the increment done while
+  identifying the file is returned alongside the result, to be accumulated by the parent process.
+  '''
+  global count_hachoir
+  folder, name, stats = task
+  count_before = count_hachoir
+  result = identify_file(os.path.join(folder, name), name, stats=stats, **options)
+  return result, count_hachoir - count_before, profiling.collect() if profiling.enabled else None
+
+def identify_files(tasks, executor=None, jobs=1, limits=None, backlog=None, **options):
+  ''' Yields 'identify_file' results for (folder, name, stats) tasks, in the same order as the tasks.
+  If an executor is provided, the work is spread across its 'jobs' workers, with 'limits' (see 'scheduler.device_limits')
+  bounding the files of each device in flight.
+  With 'backlog', 'tasks' can be any iterable, read as the files are identified (no more than 'backlog' tasks at a time).
+  Any other options are passed to 'identify_file'.
+  '''
+  global count_hachoir
+  if executor is None:
+    for folder, name, stats in tasks:
+      yield identify_file(os.path.join(folder, name), name, stats=stats, **options)
+  else:
+    if limits is not None:
+      results = scheduler.schedule(tasks, executor, partial(identify_task, **options), limits, backlog=backlog)
+    else:
+      # Small chunks keep the progress bar responsive while limiting the IPC overhead
+      chunksize = max(1, min(64, (len(tasks) if backlog is None else backlog) // (jobs * 16)))
+      if backlog is None:
+        results = executor.map(partial(identify_task, **options), tasks, chunksize=chunksize)
+      else:
+        results = scheduler.bounded_map(executor, partial(identify_task, **options), tasks, backlog // 2, chunksize=chunksize)
+    for result, hachoir_increment, metrics in results:
+      count_hachoir += hachoir_increment
+      if metrics: profiling.merge(metrics)
+      yield result
+
+def scan(path):
+  ''' Yields (folder, name, stats) for every file under 'path', in the same order as 'os.walk' would,
+  skipping ignored folders and files. Each file is stat'ed once.
+  '''
+  try:
+    entries = os.scandir(path)
+  except OSError:
+    # As 'os.walk' does, unreadable folders are skipped
+    print("{}Cannot access '{}'{}".format(Fore.RED, path, Fore.RESET))
+    return
+
+  files = []
+  folders = []
+  with entries:
+    for entry in entries:
+      try:
+        if entry.is_dir():
+          # As 'os.walk' does, symbolic links to folders are not followed
+          if not entry.is_symlink() and not IGNORED_FOLDERS_REGEX.match(entry.name):
+            folders.append(entry.path)
+        elif not IGNORED_FILES_REGEX.match(entry.name):
+          files.append((entry.name, entry.stat()))
+      except OSError:
+        print("{}Cannot access '{}'{}".format(Fore.RED, entry.path, Fore.RESET))
+
+  for name, stats in files:
+    yield path, name, stats
+  for folder in folders:
+    yield from scan(folder)
+
+@lru_cache(maxsize=1024)
+def real_folder(folder):
+  return os.path.realpath(folder)
+
+def entry_key(folder, name, stats):
+  ''' Identifies an unchanged file across extractions '''
+  return (real_folder(folder), name, stats.st_size, dt.fromtimestamp(stats.st_mtime))
+
+def load_known_entries(datafilename):
+  ''' Reads the 'ok' and 'error' entries of a previous datafile, for an incremental extraction.
+  Returns the tables and a mapping from entry key (real folder, name, size, mtime) to (table, index, inode).
+  The inode is None for datafiles generated before it was recorded.
+  '''
+  tables = {}
+  known = {}
+  wd = '.'
+  with pd.HDFStore(datafilename, mode='r') as store:
+    if '/info' in store:
+      wd = store['info'].loc[0, 'wd']
+    for key in ['ok', 'error']:
+      tables[key] = store[key] if '/{}'.format(key) in store else pd.DataFrame()
+
+  for key, table in tables.items():
+    if len(table) == 0:
+      continue
+    real_folders = {folder: os.path.realpath(os.path.join(wd, folder)) for folder in table.folder.unique()}
+    inodes = table['inode'] if 'inode' in table.columns else pd.Series(None, index=table.index, dtype=object)
+    for index, folder, name, size, mtime, inode in zip(table.index, table.folder, table.name, table['size'], table.mtime, inodes):
+      known[(real_folders[folder], name, size, mtime.to_pydatetime())] = (key, index, None if pd.isna(inode) else inode)
+
+  return tables, known
+
+def match_known(known, folder, name, stats):
+  ''' Returns the (table, index) of the previously extracted entry for this file, if it hasn't changed '''
+  if not known:
+    return None
+  entry = known.get(entry_key(folder, name, stats))
+  if entry is None:
+    return None
+  table, index, inode = entry
+  if inode is not None and inode != stats.st_ino:
+    return None
+  return table, index
+
+def walk_sources(space, working_info, known=None, completed=None, reused=None):
+  ''' Yields (group, (folder, name, stats)) for every file to identify in 'space' (a list of files, folders or patterns),
+  as the folders are scanned. Files matching 'known' entries are added to 'reused' (by group) instead.
+  '''
+  for source in space:
+    for path in glob.iglob(source):
+      if os.path.isfile(path):
+        if path in completed:
+          continue
+        files = [(path, *os.path.split(path), os.stat(path))]
       else:
-        if verbose: print("   {}NOT even NOW - {}".format(Fore.RED, name))
+        working_info['sources'].append(path)
+        files = ((p, p, file, stats) for p, file, stats in scan(path) if p not in completed)
+
+      for group, p, file, stats in files:
+        match = match_known(known, p, file, stats)
+        if match:
+          reused.setdefault(group, []).append((*match, p))
+          continue
+        yield group, (p, file, stats)
 
-  return (datetime, make, model, digest, mime, code, stats.st_size, atime, mtime, ctime, has_json)
+def interleave(walks):
+  ''' The files of several walks (see 'walk_sources'), a folder of each walk at a time '''
+  walks = [iter(walk) for walk in walks]
+  heads = [next(walk, None) for walk in walks]
+  while any(head is not None for head in heads):
+    for position, walk in enumerate(walks):
+      head = heads[position]
+      group = head[0] if head is not None else None
+      while head is not None and head[0] == group:
+        yield head
+        head = next(walk, None)
+      heads[position] = head
 
-def filter_out(n, f):
-  for ign in IGNORED_FOLDERS:
-    if ign in n: n.remove(ign)
-  for ign in IGNORED_FILES:
-    if ign in f: f.remove(ign)
-  for ign in IGNORED_PATTERNS:
-    f = list(filter(lambda x: ign.match(x) is None,f))
-  return n, f
+def timed_walk(walk):
+  ''' A walk (see 'walk_sources') accounting the time spent scanning to the 'walk' stage '''
+  walk = iter(walk)
+  while True:
+    with profiling.stage('walk'):
+      item = next(walk, None)
+    if item is None:
+      return
+    yield item
 
-def explore(space, working_info):
+def explore_folders(space, working_info, jobs=1, known=None, staged=False, completed=None, metadata_only=False, device_jobs=None, phash=False, stream=False):
   """ files can be either a file, a folder or a pattern
     It can also be a list of files, folders or patterns.
+    Yields (folder, data, reused) once every file of a folder has been processed (single files are yielded by path).
+    With 'jobs' > 1 files are identified by a pool of worker processes (the order of the rows is kept).
+    With 'device_jobs' (paths mapped to a number of files in flight, see 'scheduler'), files of every device are
+    identified at the same time, each device with its own number of files in flight ('jobs' if not given).
+    'known' entries (see 'load_known_entries') are not identified again, but returned as (table, index, folder) in the reused list.
+    With 'staged', files are not hashed (see 'digests.resolve_digests').
+    With 'metadata_only', files are not hashed and only their metadata is read (see 'identify_file').
+    With 'phash', pictures get a perceptual hash (see 'similarity').
+    Folders (or single files) in 'completed' are skipped.
+    With 'stream', files are identified while the folders are scanned, no more than 'STREAM_BACKLOG' files being
+    gathered at a time (with 'device_jobs', sources are scanned a folder of each at a time, to be read together).
+    Otherwise files of every source are gathered first, so the progress can be told.
   """
-  data = []
   working_info['sources'] = []
+  completed = completed or set()
 
   if type(space) is not list:
     space = [space]
 
-  for source in space:
-    for path in glob.iglob(source):
-      if os.path.isfile(path):
-        datetime, make, model, digest, mime, code, size, atime, mtime, ctime, has_json = identify_file(path, os.path.split(path)[1])
-        data.append([*os.path.split(path), datetime, make, model, digest, code, size, atime, mtime, ctime, has_json ])
-      else:
-        working_info['sources'].append(path)
-        # Pre-calculation of data size to process
-        total_size = 0
-        for p,n,f in os.walk(path):
-          n, f = filter_out(n,f)
-
-          for file in f:
-            total_size += os.stat(os.path.join(p, file)).st_size
-      
-        # Gigabytes instead of Gibibytes
-        with tqdm(total=total_size, unit='B', unit_scale=True, unit_divisor=1000) as pbar:
-          for p,n,f in os.walk(path):
-            n, f = filter_out(n,f)
-            for file in tqdm(f):
-              pbar.update(os.stat(os.path.join(p, file)).st_size)
-              datetime, make, model, digest, mime, code, size, atime, mtime, ctime, has_json = identify_file(os.path.join(p,file), file)
-              if code is None:
-                continue
-      
-              data.append([p, file, datetime, make, model, digest, mime, code, size, atime, mtime, ctime, has_json ])
-              # file sizes # pbar.update()
-
-  return data
-
-def extract_data(space, datafile = None, working_info=None, verbose=0, force=False):
+  reused = {}
+  if stream:
+    if device_jobs is not None:
+      walk = interleave([walk_sources([source], working_info, known, completed, reused) for source in space])
+    else:
+      walk = walk_sources(space, working_info, known, completed, reused)
+    walk = timed_walk(walk)
+    total_size, total = None, None
+    devices = {os.stat(path).st_dev for source in space for path in glob.iglob(source)}
+  else:
+    with profiling.stage('walk'):
+      walk = list(walk_sources(space, working_info, known, completed, reused))
+    total_size, total = sum(stats.st_size for _, (_, _, stats) in walk), len(walk)
+    devices = {stats.st_dev for _, (_, _, stats) in walk}
+
+  limits = None
+  if device_jobs is not None:
+    limits = scheduler.device_limits(device_jobs, devices, default=jobs)
+    jobs = sum(limits.values())
+
+  # The group (and the task) of every file handed to 'identify_files', until its result comes
+  identifying = collections.deque()
+  def tasks():
+    for group, task in walk:
+      identifying.append((group, task))
+      yield task
+
+  executor = ProcessPoolExecutor(max_workers=jobs, initializer=profiling.enable if profiling.enabled else None) if jobs > 1 else None
+  try:
+    # Gigabytes instead of Gibibytes
+    with tqdm(total=total_size, unit='B', unit_scale=True, unit_divisor=1000) as pbar:
+      # 'scan' yields the files of each folder together
+      current, data = None, []
+      for result in tqdm(identify_files(tasks() if stream else list(tasks()), executor, jobs, limits=limits, backlog=STREAM_BACKLOG if stream else None,
+                                        hashing=not staged, metadata_only=metadata_only, phash=phash), total=total):
+        group, (p, file, _) = identifying.popleft()
+        if group != current:
+          if current is not None:
+            yield current, data, reused.pop(current, [])
+          current, data = group, []
+
+        datetime, make, model, digest, mime, code, size, atime, mtime, ctime, has_json, inode, perceptual_hash = result
+        pbar.update(size)
+        if code is None:
+          continue
+
+        data.append([p, file, datetime, make, model, digest, mime, code, size, atime, mtime, ctime, has_json, inode, perceptual_hash ])
+      if current is not None:
+        yield current, data, reused.pop(current, [])
+
+    # Folders (and single files) where every file was reused
+    for group, group_reused in reused.items():
+      yield group, [], group_reused
+  finally:
+    if executor is not None:
+      executor.shutdown()
+
+def explore(space, working_info, jobs=1, known=None, staged=False, metadata_only=False, device_jobs=None, phash=False):
+  """ Returns the data and reused entries of all files (see 'explore_folders') """
+  data = []
+  reused = []
+  for _, folder_data, folder_reused in explore_folders(space, working_info, jobs=jobs, known=known, staged=staged, metadata_only=metadata_only, device_jobs=device_jobs, phash=phash):
+    data.extend(folder_data)
+    reused.extend(folder_reused)
+
+  return data, reused
+
+def finalize_entries(data, first_index=0):
+  ''' Splits the explored data into OK and ERROR entries, completing the 'datetime' of the OK ones '''
+  ph = pd.DataFrame(data, columns=['folder', 'name', 'datetime', 'make', 'model', 'digest', 'mime', 'code', 'size', 'atime', 'mtime', 'ctime', 'has_json', 'inode', 'phash' ],
+                    index=pd.RangeIndex(first_index, first_index + len(data)))
+  # split into OK and ERROR files
+  ph_ok, ph_error = ph[ph.code == CODE_OK].copy(), ph[ph.code != CODE_OK].copy()
+
+  # Add dummy time to 'timeless' timestamps. Tag those entries as well.
+  dates_with_no_time = ~ph_ok.datetime.str.match("^\d{4}:\d{2}:\d{2} ")
+  full_datetimes = ph_ok.loc[dates_with_no_time].datetime + " 08:00:00"
+  ph_ok['timeless'] = False
+  ph_ok.loc[dates_with_no_time, 'timeless'] = True
+  ph_ok.loc[dates_with_no_time, 'datetime'] = full_datetimes
+  ph_ok.loc[:, 'datetime'] = pd.to_datetime(ph_ok['datetime'], format="%Y:%m:%d %H:%M:%S")
+
+  return ph_ok, ph_error
+
+def info_frame(working_info):
+  ''' The 'info' table holds a single row: all explored sources are kept together '''
+  info = dict(working_info)
+  if 'sources' in info:
+    info['sources'] = [os.pathsep.join(info['sources'])]
+  return pd.DataFrame(info)
+
+def append_entries(store, key, entries, index=True):
+  ''' Appends entries to a datafile table, with room for the longest strings expected in later batches.
+  Without 'index', the table index is not updated (for tables only read as a whole).
+  '''
+  if len(entries) == 0:
+    return
+  min_itemsize = {column: size for column, size in STREAM_MIN_ITEMSIZE.items() if column in entries.columns and entries[column].dtype == object}
+  store.append(key, entries, format="table", min_itemsize=min_itemsize, index=index)
+
+def stream_data(space, datafilename, working_info, verbose=0, jobs=1, resume=False, metadata_only=False, device_jobs=None, phash=False):
+  ''' Extraction writing the entries to the datafile in batches, as folders are completed.
+  A 'checkpoint' table records the completed folders (and the size of the tables at that point),
+  so an interrupted extraction can be resumed.
+  '''
+  completed = set()
+  ok_rows, error_rows = 0, 0
+  if resume:
+    with pd.HDFStore(datafilename, mode='a') as store:
+      if '/checkpoint' not in store:
+        print("{}Datafile '{}' has no checkpoint to resume from{}".format(Fore.RED, datafilename, Fore.RESET))
+        return
+      checkpoint = store['checkpoint']
+      completed = set(checkpoint.folder)
+      ok_rows, error_rows = checkpoint.ok_rows.iloc[-1], checkpoint.error_rows.iloc[-1]
+      # Entries written after the last checkpoint belong to folders which will be processed again
+      for key, rows in [('ok', ok_rows), ('error', error_rows)]:
+        if '/{}'.format(key) in store and store.get_storer(key).nrows > rows:
+          store.remove(key, start=rows)
+    print("resuming '{}{}{}' ({} folders completed)".format(Fore.GREEN, datafilename, Fore.RESET, len(completed)))
+
+  with pd.HDFStore(datafilename, mode='a' if resume else 'w', complevel=STREAM_COMPLEVEL, complib=STREAM_COMPLIB) as store:
+    batch, batch_folders = [], []
+
+    def flush():
+      nonlocal ok_rows, error_rows, batch, batch_folders
+      ph_ok, ph_error = finalize_entries(batch, first_index=ok_rows + error_rows)
+      with profiling.stage('hdf_write'):
+        # Datafiles are always read as a whole: indexing the tables would make memory grow with every batch
+        append_entries(store, 'ok', ph_ok, index=False)
+        append_entries(store, 'error', ph_error, index=False)
+        ok_rows, error_rows = ok_rows + len(ph_ok), error_rows + len(ph_error)
+        store.append('checkpoint', pd.DataFrame({'folder': batch_folders, 'ok_rows': ok_rows, 'error_rows': error_rows}),
+                     format="table", min_itemsize={'folder': STREAM_MIN_ITEMSIZE['folder']})
+      batch, batch_folders = [], []
+
+    try:
+      for folder, data, _ in explore_folders(space, working_info, jobs=jobs, completed=completed, metadata_only=metadata_only, device_jobs=device_jobs, phash=phash, stream=True):
+        batch.extend(data)
+        batch_folders.append(folder)
+        if len(batch) >= STREAM_BATCH_SIZE:
+          flush()
+      if len(batch_folders) > 0:
+        flush()
+    except KeyboardInterrupt:
+      print("\n{}Extraction interrupted:{} run again with '--resume' to continue".format(Fore.YELLOW, Fore.RESET))
+      return False
+
+    store.put('info', storage.versioned(info_frame(working_info)), format="table")
+
+  print("\n{} entries ({} parsed by Hachoir)".format(ok_rows + error_rows, count_hachoir))
+  print("{} ok / {} error".format(ok_rows, error_rows))
+  return True
+
+def fill_perceptual_hashes(photos_df):
+  ''' Returns the 'phash' column with the pictures never hashed (i.e. reused entries) hashed.
+  Those hashed without getting a hash (NO_HASH) are not read again, nor are the files that cannot be read.
+  '''
+  hashes = photos_df['phash'].astype(object) if 'phash' in photos_df.columns else pd.Series(None, index=photos_df.index, dtype=object)
+  missing = hashes.isna() & photos_df['mime'].astype(str).str.startswith('image/')
+  for index in hashes[missing].index:
+    path = os.path.join(photos_df.loc[index, 'folder'], photos_df.loc[index, 'name'])
+    try:
+      with open(path, 'rb') as f:
+        hashes[index] = similarity.perceptual_hash(f)
+    except OSError:
+      print("{}Cannot read '{}' to compute its perceptual hash{}".format(Fore.RED, path, Fore.RESET))
+  return hashes
+
+def extract_data(space, datafile = None, working_info=None, verbose=0, force=False, jobs=1, incremental=False, staged=False, stream=False, resume=False, index=None, metadata_only=False, device_jobs=None, phash=False):
+  ''' With 'incremental', entries from an existing datafile are reused for files with the same folder, name, size and mtime
+  (and inode, if recorded). Only new or changed files are identified, and files no longer present are dropped.
+  With 'staged', only files which could be duplicates (same size, then same partial digest) are fully hashed.
+  Otherwise reused entries lacking a full digest get one.
+  With 'stream' (or 'resume'), entries are written to the datafile as the extraction goes (see 'stream_data').
+  With 'index', the entries are added to that library index (see 'library').
+  With 'metadata_only', files are not hashed (their digest is left missing) and only their metadata is read.
+  A later incremental extraction (without it) adds the missing digests.
+  With 'device_jobs', the files of every device are identified at the same time (see 'explore_folders').
+  With 'phash', pictures get a perceptual hash (see 'similarity'), reused entries lacking one included.
+  '''
   if verbose >= 1: print("As a list of spaces has been specified, analysis will take place\n")
 
   if not working_info:
     working_info = { 'wd': [os.getcwd()],
                      'hostname': [os.uname()[1]] }
-  data = explore(space, working_info)
 
-  if len(data) > 0:
-    print("\n{} entries ({} parsed by Hachoir)".format(len(data), count_hachoir))
+  if stream or resume:
+    datafilename = storage.normalize(datafile)
+    if not resume and os.path.isfile(datafilename):
+      if not (force or confirm(
+          suffix="(y/N)",
+          message="Do you want to overwrite existing datafile '{}'?".format(datafilename))):
+        print("NOT overwritting '{}{}{}'".format(Fore.YELLOW, datafilename, Fore.RESET))
+        return
+    if stream_data(space, datafilename, working_info, verbose=verbose, jobs=jobs, resume=resume, metadata_only=metadata_only, device_jobs=device_jobs, phash=phash) and index:
+      connection = library.open_index(index)
+      count = library.index_datafile(connection, datafilename)
+      connection.close()
+      print("{} entries indexed in '{}{}{}'".format(count, Fore.GREEN, index, Fore.RESET))
+    return
 
-    ph = pd.DataFrame(data, columns=['folder', 'name', 'datetime', 'make', 'model', 'digest', 'mime', 'code', 'size', 'atime', 'mtime', 'ctime', 'has_json' ])
-    # split into OK and ERROR files
-    ph_ok, ph_error = ph[ph.code == CODE_OK].copy(), ph[ph.code != CODE_OK].copy()
-    print("{} ok / {} error".format(len(ph_ok), len(ph_error)))
+  previous_tables, known = {}, None
+  if incremental and datafile and os.path.isfile(storage.normalize(datafile)):
+    previous_tables, known = load_known_entries(storage.normalize(datafile))
+    print("incremental extraction over '{}{}{}' ({} known entries)".format(Fore.GREEN, storage.normalize(datafile), Fore.RESET, len(known)))
+  data, reused = explore(space, working_info, jobs=jobs, known=known, staged=staged, metadata_only=metadata_only, device_jobs=device_jobs, phash=phash)
+
+  if len(data) + len(reused) > 0:
+    print("\n{} entries ({} parsed by Hachoir, {} reused)".format(len(data) + len(reused), count_hachoir, len(reused)))
 
-    # Add dummy time to 'timeless' timestamps. Tag those entries as well.
-    dates_with_no_time = ~ph_ok.datetime.str.match("^\d{4}:\d{2}:\d{2} ")   
-    full_datetimes = ph_ok.loc[dates_with_no_time].datetime + " 08:00:00"
-    ph_ok['timeless'] = False
-    ph_ok.loc[dates_with_no_time, 'timeless'] = True
-    ph_ok.loc[dates_with_no_time, 'datetime'] = full_datetimes
-    ph_ok.loc[:, 'datetime'] = pd.to_datetime(ph_ok['datetime'], format="%Y:%m:%d %H:%M:%S")
+    ph_ok, ph_error = finalize_entries(data)
+
+    # Reused entries were already processed. Analysis results refer to the previous indexes, so they are not kept
+    if len(reused) > 0:
+      reused = pd.DataFrame(reused, columns=['table', 'index', 'folder'])
+      reused_tables = []
+      for key, ph_new in [('ok', ph_ok), ('error', ph_error)]:
+        reused_entries = reused[reused.table == key]
+        ph_reused = previous_tables[key].loc[reused_entries['index']].drop(['should_remove', 'persist_version'], axis=1, errors='ignore')
+        ph_reused['folder'] = reused_entries['folder'].values
+        # Empty frames are left out of the concatenation, as they would turn typed columns into 'object'
+        reused_tables.append(pd.concat([ph_reused, ph_new], ignore_index=True) if len(ph_new) > 0 else ph_reused.reset_index(drop=True))
+      ph_ok, ph_error = reused_tables
+
+    # Duplicates are only looked for within each table, so digests are resolved per table
+    for ph_table in [ph_ok, ph_error]:
+      # Tables missing from the previous datafile are reused without any column
+      if len(ph_table) == 0:
+        continue
+      if staged:
+        ph_table['digest'] = digests.resolve_digests(ph_table, verbose=verbose)
+      elif len(reused) > 0 and not metadata_only:
+        ph_table['digest'] = digests.fill_digests(ph_table)
+      if phash and len(reused) > 0:
+        ph_table['phash'] = fill_perceptual_hashes(ph_table)
+    print("{} ok / {} error".format(len(ph_ok), len(ph_error)))
 
     # Save data
     if datafile:
       datafilename = storage.normalize(datafile)
       create_file = True
-      if os.path.isfile(datafilename):  
+      if incremental and known is not None:
+        print("updating '{}{}{}'".format(Fore.GREEN, datafilename, Fore.RESET))
+      elif os.path.isfile(datafilename):
         create_file = force or confirm(
           suffix="(y/N)",
           message="Do you want to overwrite existing datafile '{}'?".format(datafilename))
@@ -225,6 +782,16 @@ def extract_data(space, datafile = None, working_info=None, verbose=0, force=Fal
         else:
           print("overwritting '{}{}{}'".format(Fore.GREEN, datafilename, Fore.RESET))
       if create_file:
-        ph_ok.to_hdf(datafilename, key='ok', format="table")
-        ph_error.to_hdf(datafilename, key='error', format="table")
-        pd.DataFrame(working_info).to_hdf(datafilename, key='info', format="table")
+        with profiling.stage('hdf_write'):
+          storage.write_table(ph_ok, datafilename, 'ok')
+          storage.write_table(ph_error, datafilename, 'error')
+          storage.versioned(info_frame(working_info)).to_hdf(datafilename, key='info', format="table")
+
+    if index:
+      connection = library.open_index(index)
+      if datafile and create_file:
+        count = library.index_datafile(connection, datafilename)
+      else:
+        count = sum(library.index_entries(connection, ph_table, working_info['wd'][0]) for ph_table in [ph_ok, ph_error])
+      connection.close()
+      print("{} entries indexed in '{}{}{}'".format(count, Fore.GREEN, index, Fore.RESET))
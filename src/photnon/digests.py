@@ -0,0 +1,121 @@
+# Staged digests: most files have a unique size, and so can never be duplicates.
+# Instead of hashing every byte, files are grouped by size, colliding sizes get a cheap
+# partial digest (head and tail blocks), and only files still colliding get a full digest.
+#
+# Skipped digests are recorded as pseudo-digests starting with SKIPPED_DIGEST_PREFIX, which
+# are unique within the table they were resolved for, so duplicate detection keeps working.
+# When tables are merged, 'resolve_digests' can be applied again to fill them in where needed.
+
+import os
+import hashlib
+import pandas as pd
+
+from colorama import init, Fore
+init(autoreset=True)
+
+CHUNK_SIZE = 2**20 # 1 MB
+PARTIAL_BLOCK_SIZE = 2**16 # 64 kB, read from both the head and the tail of the file
+
+SKIPPED_DIGEST_PREFIX = '~'
+
+def file_digest(path):
+  digester = hashlib.sha1()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+      digester.update(chunk)
+  return digester.hexdigest()
+
+def partial_digest(path, size):
+  digester = hashlib.sha1()
+  with open(path, "rb") as f:
+    digester.update(f.read(PARTIAL_BLOCK_SIZE))
+    if size > 2 * PARTIAL_BLOCK_SIZE:
+      f.seek(-PARTIAL_BLOCK_SIZE, os.SEEK_END)
+      digester.update(f.read(PARTIAL_BLOCK_SIZE))
+    elif size > PARTIAL_BLOCK_SIZE:
+      digester.update(f.read())
+  return digester.hexdigest()
+
+def skipped_digest(size, partial=None):
+  if partial is None:
+    return "{}{}".format(SKIPPED_DIGEST_PREFIX, size)
+  return "{}{}:{}".format(SKIPPED_DIGEST_PREFIX, size, partial)
+
+def is_skipped(digests):
+  ''' Entries without a full digest (either never computed or skipped by the staged process) '''
+  return digests.isna() | digests.astype(str).str.startswith(SKIPPED_DIGEST_PREFIX)
+
+def recorded_partial(digest):
+  ''' The partial digest stored as part of a pseudo-digest, if any '''
+  if isinstance(digest, str) and digest.startswith(SKIPPED_DIGEST_PREFIX) and ':' in digest:
+    return digest.split(':', 1)[1]
+  return None
+
+def resolve_digests(photos_df, verbose=0):
+  '''
+  Returns the 'digest' column with the skipped entries resolved as far as needed to tell duplicates apart:
+  1. Entries with a unique size keep (or get) a size pseudo-digest
+  2. Entries sharing their size with others get a partial digest (reusing the one recorded, if any)
+  3. Entries sharing both size and partial digest get a full digest
+
+  Files that cannot be read (i.e. not mounted on this machine) get a pseudo-digest including their path,
+  so they are never taken as duplicates.
+  '''
+  digests = photos_df['digest'].copy() if 'digest' in photos_df.columns else pd.Series(None, index=photos_df.index, dtype=object)
+  skipped = is_skipped(digests)
+  if not skipped.any():
+    return digests
+
+  paths = photos_df['folder'].str.cat(photos_df['name'], sep=os.path.sep)
+  sizes = photos_df['size']
+
+  # Only size groups with skipped entries need further work
+  colliding = sizes.duplicated(keep=False) & sizes.isin(sizes[skipped].unique())
+  unique_size = skipped & ~colliding
+  digests[unique_size] = sizes[unique_size].map(skipped_digest)
+
+  partials = pd.Series(None, index=photos_df.index, dtype=object)
+  for index in colliding[colliding].index:
+    partial = recorded_partial(digests[index])
+    if partial is None:
+      try:
+        partial = partial_digest(paths[index], sizes[index])
+      except OSError:
+        print("{}Cannot read '{}' to compute its partial digest{}".format(Fore.RED, paths[index], Fore.RESET))
+        partial = skipped_digest(sizes[index], paths[index])
+    partials[index] = partial
+
+  candidates = pd.DataFrame({'size': sizes[colliding], 'partial': partials[colliding]})
+  still_colliding = candidates.duplicated(keep=False)
+
+  for index in candidates.index:
+    if not skipped[index]:
+      continue
+    if still_colliding[index]:
+      try:
+        digests[index] = file_digest(paths[index])
+      except OSError:
+        print("{}Cannot read '{}' to compute its digest{}".format(Fore.RED, paths[index], Fore.RESET))
+        digests[index] = skipped_digest(sizes[index], paths[index])
+    else:
+      digests[index] = skipped_digest(sizes[index], partials[index])
+
+  if verbose >= 1: print("staged digests: {} by size / {} by partial digest / {} full".format(
+                          sum(unique_size),
+                          sum(skipped & colliding & ~still_colliding.reindex(photos_df.index, fill_value=False)),
+                          sum(skipped & colliding & still_colliding.reindex(photos_df.index, fill_value=False))
+                        ))
+  return digests
+
+def fill_digests(photos_df):
+  ''' Returns the 'digest' column with every skipped entry fully digested.
+  Files that cannot be read keep their digest, to be completed by a later extraction.
+  '''
+  digests = photos_df['digest'].copy()
+  for index in digests[is_skipped(digests)].index:
+    path = os.path.join(photos_df.loc[index, 'folder'], photos_df.loc[index, 'name'])
+    try:
+      digests[index] = file_digest(path)
+    except OSError:
+      print("{}Cannot read '{}' to compute its digest{}".format(Fore.RED, path, Fore.RESET))
+  return digests
@@ -0,0 +1,58 @@
+# Folder statistics, used to offer the preferred folder when processing duplicates.
+#
+# Folders are split into their path tokens and kept in a prefix tree, each node holding the number
+# of files directly in it. Counts are aggregated bottom-up, a level at a time, listing the file count
+# of every prefix, except that chains of single-child folders are collapsed: a folder whose only
+# listed child is one level below is not listed, and its files are not counted for its ancestors.
+
+import os
+import pandas as pd
+
+def folder_tree(folder_counts):
+  ''' Prefix tree (nested dicts: token -> node) from a folder -> number of files mapping.
+  Returns the root node and the nodes of every depth, as (path tokens, node) pairs.
+  '''
+  root = {'files': 0, 'children': {}}
+  levels = {}
+  for folder, count in folder_counts.items():
+    node = root
+    tokens = tuple(folder.split(os.path.sep))
+    for depth in range(1, len(tokens) + 1):
+      child = node['children'].get(tokens[depth-1])
+      if child is None:
+        child = node['children'][tokens[depth-1]] = {'files': 0, 'children': {}}
+        levels.setdefault(depth, []).append((tokens[:depth], child))
+      node = child
+    node['files'] += count
+  return root, levels
+
+def collapsed_folder_counts(folders):
+  ''' Number of files of every listed folder prefix (see above), sorted by number of files, from the folder of every file '''
+  return collapsed_counts(folders.value_counts())
+
+def collapsed_counts(folder_counts):
+  ''' As 'collapsed_folder_counts', from the number of files of every folder '''
+  _, levels = folder_tree(folder_counts[folder_counts > 0])
+
+  counts = {}
+  listed = None
+  # The deepest level is listed as it is, and every level above it considering the ones listed below
+  for depth in range(max(levels, default=0), 1, -1):
+    level = {}
+    for tokens, node in sorted(levels[depth], key=lambda level_node: level_node[0]):
+      node['total'] = node['files'] + sum(child.get('total', 0) for child in node['children'].values())
+      if node['total'] == 0:
+        continue
+      if listed is not None:
+        listed_children = [child for child in node['children'].values() if id(child) in listed]
+        if len(listed_children) == 1:
+          node['total'] = 0
+          continue
+      level[id(node)] = (tokens, node['total'])
+
+    if listed is not None and len(level) == 0:
+      break
+    listed = level
+    counts.update({os.path.sep.join(tokens): total for tokens, total in level.values()})
+
+  return pd.Series(counts, dtype='int64').sort_values(ascending=False, kind='mergesort')
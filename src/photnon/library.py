@@ -0,0 +1,103 @@
+# Library index: a SQLite database with the path, size and digest of every file in the library.
+# It is built from datafiles (or updated while extracting), so incoming files can be checked
+# against the library with point lookups, instead of extracting and analysing them together.
+#
+# Files are looked up by size first, so incoming files with a size not in the library are new
+# without reading them. Library files without a full digest (see 'digests') are hashed when needed.
+
+import os
+import sqlite3
+
+from photnon import digests
+from photnon.data_analysis import REMOVAL_CODE_SCHEDULE
+
+import pandas as pd
+
+from colorama import init, Fore
+init(autoreset=True)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+  path TEXT PRIMARY KEY,
+  digest TEXT,
+  size INTEGER NOT NULL,
+  mtime TEXT,
+  datafile TEXT
+);
+CREATE INDEX IF NOT EXISTS files_size_digest ON files (size, digest);
+'''
+
+def open_index(filename):
+  connection = sqlite3.connect(filename)
+  connection.executescript(SCHEMA)
+  return connection
+
+def index_entries(connection, entries, wd='.', datafile=None):
+  ''' Adds (or updates, by path) the entries of an 'ok' or 'error' table, with folders relative to 'wd'.
+  Entries scheduled for removal by an analysis are left out.
+  '''
+  if 'should_remove' in entries.columns:
+    entries = entries[entries['should_remove'] != REMOVAL_CODE_SCHEDULE]
+  if len(entries) == 0:
+    return 0
+
+  real_folders = {folder: os.path.realpath(os.path.join(wd, folder)) for folder in entries['folder'].unique()}
+  paths = entries['folder'].map(real_folders).astype(object).str.cat(entries['name'], sep=os.path.sep)
+  entry_digests = entries['digest'].where(~digests.is_skipped(entries['digest']), None)
+  mtimes = entries['mtime'].dt.strftime("%Y-%m-%d %H:%M:%S") if 'mtime' in entries.columns else pd.Series(None, index=entries.index)
+
+  with connection:
+    connection.executemany("INSERT OR REPLACE INTO files (path, digest, size, mtime, datafile) VALUES (?, ?, ?, ?, ?)",
+                           zip(paths, entry_digests, entries['size'].astype(int), mtimes, [datafile] * len(entries)))
+  return len(entries)
+
+def index_datafile(connection, datafilename):
+  ''' Replaces the entries previously indexed from the datafile with its current ones '''
+  with pd.HDFStore(datafilename, mode='r') as store:
+    wd = store['info'].loc[0, 'wd'] if '/info' in store else '.'
+    tables = [store[key] for key in ['ok', 'error'] if '/{}'.format(key) in store]
+
+  with connection:
+    connection.execute("DELETE FROM files WHERE datafile = ?", (os.path.realpath(datafilename),))
+  return sum(index_entries(connection, entries, wd, os.path.realpath(datafilename)) for entries in tables)
+
+def known_copies(connection, path, size):
+  ''' Paths of the library files with the same content as 'path' (other than itself) '''
+  real_path = os.path.realpath(path)
+  candidates = [(p, d) for p, d in connection.execute("SELECT path, digest FROM files WHERE size = ?", (size,)) if p != real_path]
+  if len(candidates) == 0:
+    return []
+
+  digest = digests.file_digest(path)
+  copies = [p for p, d in candidates if d == digest]
+  for p, d in candidates:
+    if d is None:
+      try:
+        d = digests.file_digest(p)
+      except OSError:
+        continue
+      with connection:
+        connection.execute("UPDATE files SET digest = ? WHERE path = ?", (d, p))
+      if d == digest:
+        copies.append(p)
+  return copies
+
+def check_files(connection, files):
+  ''' Lists every incoming file, given as (folder, name, stats), as new or known (with the paths of its known copies) '''
+  new = known = 0
+  for folder, name, stats in files:
+    path = os.path.join(folder, name)
+    try:
+      copies = known_copies(connection, path, stats.st_size)
+    except OSError:
+      print("{}Cannot read '{}'{}".format(Fore.RED, path, Fore.RESET))
+      continue
+    if copies:
+      known += 1
+      print("{}KNOWN{} {} = {}".format(Fore.YELLOW, Fore.RESET, path, ' / '.join(copies)))
+    else:
+      new += 1
+      print("{}NEW{}   {}".format(Fore.GREEN, Fore.RESET, path))
+
+  print("{} new / {} known".format(new, known))
+  return new, known
@@ -0,0 +1,299 @@
+# Out-of-core analysis, for libraries whose entries do not fit in memory at once.
+#
+# The datafiles are read in chunks and their entries split into partitions (temporary stores), so that all the
+# entries which could be duplicates of each other end up in the same one: partitions are made by file size, as
+# entries sharing a digest always share their size (and so do the entries whose staged digests still need to be
+# resolved, see 'digests.resolve_digests'). The removal decisions are then taken partition by partition, optionally
+# in several processes, and merged back into the output datafile while reading the datafiles again.
+#
+# Peak memory is bounded by the largest partition (plus the decisions taken on duplicates, a few integers each, and
+# their digests: ties are broken by the order of all duplicates sorted by digest, see 'data_analysis.lookup_order').
+# Entries are numbered as 'read_datafiles' does (their position once all datafiles are put together), so the
+# decisions are the same as those of the in-memory analysis.
+
+import os
+import shutil
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+from tqdm import tqdm
+from colorama import Fore
+
+from photnon import storage
+from photnon import digests
+from photnon import profiling
+from photnon.data_extraction import append_entries
+from photnon.data_analysis import sanitize_folders, enrich, generate_dupes_info, dupes_candidates, lookup_order, dupes_manifest_entries, write_dupes_manifest, bsize_value, template_env
+from photnon.data_analysis import REMOVAL_CODE_IGNORE, REMOVAL_CODE_SCHEDULE, PERSIST_VERSION_KEEP, DIVERGENT_COLUMNS
+
+CHUNK_SIZE = 20000 # Entries are converted to fixed-width strings (over 1 kB each) when written
+TABLES = [('ok', 'OK'), ('error', 'ERROR')]
+DECISION_COLUMNS = ['should_remove', 'persist_version']
+
+def objects(entries):
+  ''' Categorical columns back to objects: categories differ between chunks and datafiles '''
+  return entries.astype({column: object for column in entries.columns[entries.dtypes == 'category']})
+
+def working_infos(running_working_info, datafiles):
+  ''' The 'info' table of every datafile (those having one) '''
+  infos = []
+  for datafile in datafiles:
+    with pd.HDFStore(storage.normalize(datafile), mode='r') as store:
+      if '/info' not in store:
+        print("{}Datafile '{}{}{}' doesn't contain 'info':{} be extra vigilant\n".format(Fore.RED, Fore.GREEN, datafile, Fore.RED, Fore.RESET))
+        continue
+      info = store['info']
+    if info.loc[0, 'hostname'] != running_working_info['hostname'][0]:
+      print("Datafile '{}{}{}' was generated at {}, but analysis is running on {}".format(
+          Fore.GREEN, datafile, Fore.RESET, info.loc[0, 'hostname'], running_working_info['hostname'][0]))
+    infos.append(info)
+  return pd.concat(infos) if infos else pd.DataFrame()
+
+def table_template(datafiles, key):
+  ''' An empty frame with the columns (and types) of table 'key' in all datafiles, None if none has it '''
+  heads = []
+  for datafile in datafiles:
+    with pd.HDFStore(storage.normalize(datafile), mode='r') as store:
+      if '/{}'.format(key) in store:
+        heads.append(objects(store.select(key, stop=0)))
+  if len(heads) == 0:
+    return None
+  return pd.concat(heads).drop(columns=DECISION_COLUMNS, errors='ignore')
+
+def read_chunks(datafiles, key, template, force=False, chunksize=CHUNK_SIZE):
+  '''
+  Yields the entries of table 'key' of every datafile in chunks, with their folders sanitized and the columns of 'template'.
+  Entries are indexed by their position once all datafiles are put together, and those scheduled for removal by a
+  previous analysis are left out (unless 'force').
+  '''
+  offset = 0
+  for datafile in datafiles:
+    with pd.HDFStore(storage.normalize(datafile), mode='r') as store:
+      if '/{}'.format(key) not in store:
+        continue
+      wd = store['info'].loc[0, 'wd'] if '/info' in store else None
+      for chunk in store.select(key, chunksize=chunksize):
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        offset += len(chunk)
+        if not force and 'should_remove' in chunk.columns:
+          chunk = chunk[chunk.should_remove != REMOVAL_CODE_SCHEDULE]
+        chunk = objects(chunk).reindex(columns=template.columns).astype(template.dtypes.to_dict())
+        if wd is not None:
+          chunk['folder'] = sanitize_folders(chunk['folder'], wd)
+        yield chunk
+
+def partition_of(sizes, partitions):
+  return pd.util.hash_array(sizes.to_numpy()) % partitions
+
+def partition_path(tempdir, partition):
+  return os.path.join(tempdir, "partition_{}.h5".format(partition))
+
+def partition_datafiles(datafiles, tempdir, partitions, force=False, chunksize=CHUNK_SIZE):
+  '''
+  Splits the entries of the datafiles into 'partitions' stores in 'tempdir'.
+  Returns the template of every table (see 'table_template') and the number of entries of every folder.
+  '''
+  templates = {key: table_template(datafiles, key) for key, _ in TABLES}
+  folder_counts = pd.Series(dtype='int64')
+  for key, template in templates.items():
+    if template is None:
+      continue
+    for chunk in read_chunks(datafiles, key, template, force=force, chunksize=chunksize):
+      folder_counts = folder_counts.add(chunk['folder'].value_counts(), fill_value=0)
+      for partition, entries in chunk.groupby(partition_of(chunk['size'], partitions)):
+        # Stores are only open while appending: every open table holds its own I/O buffers
+        with pd.HDFStore(partition_path(tempdir, partition), mode='a') as store:
+          append_entries(store, key, entries, index=False)
+  return templates, folder_counts.astype('int64').sort_values(ascending=False)
+
+def state_path(path, key):
+  return "{}.{}.pkl".format(path, key)
+
+def prepare_partition(path, key, resolve=False):
+  '''
+  First step of the decisions on table 'key' of a partition: its entries are prepared as the in-memory analysis does, and
+  saved for the next steps ('decide_full' and 'decide_digest'). Returns the result of the partition (see 'decide_digest'),
+  and the digests of the entries the full duplicates are decided on.
+  '''
+  result = {'entries': 0, 'dropped': pd.Index([], dtype='int64'), 'digests': pd.Series(dtype=object),
+            'decisions': pd.DataFrame(columns=DECISION_COLUMNS, dtype='int64'),
+            'duplicates': 0, 'removed': 0, 'removed_size': 0, 'groups': 0}
+  if not os.path.exists(path):
+    return result, pd.Series(dtype=object)
+  with pd.HDFStore(path, mode='r') as store:
+    if '/{}'.format(key) not in store:
+      return result, pd.Series(dtype=object)
+    photos_df = store[key]
+
+  if resolve and 'digest' in photos_df.columns:
+    resolved = digests.resolve_digests(photos_df)
+    changed = resolved.ne(photos_df['digest']) & resolved.notna()
+    photos_df['digest'] = resolved
+    result['digests'] = resolved[changed]
+  unique = ~photos_df.duplicated(keep='first')
+  result['dropped'] = photos_df.index[~unique]
+  photos_df = photos_df[unique].copy()
+  result['entries'] = len(photos_df)
+  if key == 'ok':
+    enrich(photos_df)
+
+  dup_full = photos_df.duplicated(keep=False, subset=photos_df.columns[1:].drop(DIVERGENT_COLUMNS, errors='ignore'))
+  list_digest = photos_df.digest.value_counts()
+  dup_digest = photos_df.digest.isin(list_digest[list_digest > 1].index.values)
+
+  photos_df['should_remove'] = REMOVAL_CODE_IGNORE
+  photos_df['persist_version'] = PERSIST_VERSION_KEEP
+  pd.to_pickle((photos_df, dup_full, dup_digest), state_path(path, key))
+  return result, dupes_candidates(photos_df, dup_full)['digest']
+
+def decide_full(path, key, preferred_folder=False, order=None):
+  '''
+  Second step: decisions on the full duplicates of table 'key' of a partition, in the 'lookup_order' of all partitions.
+  Returns the digests of the entries the digest duplicates are decided on.
+  '''
+  if not os.path.exists(state_path(path, key)):
+    return pd.Series(dtype=object)
+  photos_df, dup_full, dup_digest = pd.read_pickle(state_path(path, key))
+  if dup_full.any():
+    generate_dupes_info(photos_df, dup_full, preferred_folder, order=order)
+  pd.to_pickle((photos_df, dup_full, dup_digest), state_path(path, key))
+  return dupes_candidates(photos_df, dup_digest)['digest']
+
+def decide_digest(path, key, result, preferred_folder=False, order=None, manifest=None):
+  '''
+  Last step: decisions on the digest duplicates of table 'key' of a partition (the digest groups are written to 'manifest').
+  Returns the 'result' of the partition, with what differs from the default decisions.
+  '''
+  if not os.path.exists(state_path(path, key)):
+    return result
+  photos_df, dup_full, dup_digest = pd.read_pickle(state_path(path, key))
+  os.remove(state_path(path, key))
+  if dup_digest.any():
+    generate_dupes_info(photos_df, dup_digest, preferred_folder, order=order)
+    if manifest is not None:
+      result['groups'] = write_dupes_manifest(dupes_manifest_entries(photos_df, dup_digest), manifest)
+
+  decided = (photos_df['should_remove'] != REMOVAL_CODE_IGNORE) | (photos_df['persist_version'] != PERSIST_VERSION_KEEP)
+  removed = photos_df['should_remove'] == REMOVAL_CODE_SCHEDULE
+  result.update({'decisions': photos_df.loc[decided, DECISION_COLUMNS].astype('int64'),
+                 'duplicates': int(dup_digest.sum()),
+                 'removed': int(removed.sum()),
+                 'removed_size': int(photos_df.loc[removed, 'size'].sum())})
+  return result
+
+def run_partitions(function, arguments, tasks, progress, executor=None):
+  ''' Runs 'function' on every (key, partition) task, with the 'arguments' of the task, returning the results by task '''
+  results = {}
+  if executor is not None:
+    futures = {executor.submit(function, *arguments(*task)): task for task in tasks}
+    for future in as_completed(futures):
+      results[futures[future]] = future.result()
+      progress.update()
+  else:
+    for task in tasks:
+      results[task] = function(*arguments(*task))
+      progress.update()
+  return results
+
+def split_order(candidates, tasks):
+  '''
+  The 'lookup_order' of the candidate entries of every table (all partitions put together, in the order of the entries,
+  as the in-memory analysis sorts them), split by task
+  '''
+  orders = {}
+  for key in set(key for key, _ in tasks):
+    order = lookup_order(pd.concat([candidates[task] for task in tasks if task[0] == key]).sort_index())
+    orders.update({task: order.reindex(candidates[task].index) for task in tasks if task[0] == key})
+  return orders
+
+def decide_partitions(tempdir, partitions, keys, jobs=1, preferred_folder=False, resolve=False):
+  '''
+  Takes the decisions on every table of every partition (in 'jobs' processes), returning the results by table.
+  The decisions on full duplicates, then on digest duplicates, depend on the order of all the candidate entries
+  (see 'lookup_order'), which is put together between the steps.
+  '''
+  tasks = [(key, partition) for key in keys for partition in range(partitions)]
+  path = lambda partition: partition_path(tempdir, partition)
+  manifest = lambda key, partition: os.path.join(tempdir, "dedup_{}_{}.jsonl".format(key, partition))
+  with tqdm(total=3 * len(tasks), desc='partitions', unit='step') as progress:
+    with (ProcessPoolExecutor(jobs) if jobs > 1 else contextlib.nullcontext()) as executor:
+      prepared = run_partitions(prepare_partition, lambda key, partition: (path(partition), key, resolve), tasks, progress, executor)
+      orders = split_order({task: candidates for task, (_, candidates) in prepared.items()}, tasks)
+      candidates = run_partitions(decide_full, lambda key, partition: (path(partition), key, preferred_folder, orders[(key, partition)]),
+                                  tasks, progress, executor)
+      orders = split_order(candidates, tasks)
+      decided = run_partitions(decide_digest, lambda key, partition: (path(partition), key, prepared[(key, partition)][0],
+                               preferred_folder, orders[(key, partition)], manifest(key, partition)), tasks, progress, executor)
+  return {key: [decided[(key, partition)] for partition in range(partitions)] for key in keys}
+
+def write_manifest(tempdir, partitions, key, label, script_hostname):
+  ''' Puts the digest groups of every partition together in 'dedup_<label>.jsonl', processed by 'dedup_<label>.sh' '''
+  manifest_name = "dedup_{}.jsonl".format(label)
+  with open(manifest_name, 'w') as f:
+    for partition in range(partitions):
+      part = os.path.join(tempdir, "dedup_{}_{}.jsonl".format(key, partition))
+      if os.path.exists(part):
+        with open(part) as p:
+          shutil.copyfileobj(p, f)
+  template_env.get_template('dedup_runner').stream(manifest = manifest_name,
+                script_hostname = script_hostname).dump("dedup_{}.sh".format(label))
+  os.chmod("dedup_{}.sh".format(label), 0o755)
+
+def write_output(datafiles, datafilename, templates, merged, hostname, force=False, chunksize=CHUNK_SIZE):
+  ''' Writes the entries of the datafiles, with the decisions taken (and the digests resolved), to 'datafilename' '''
+  with pd.HDFStore(datafilename, mode='w', complevel=storage.COMPLEVEL, complib=storage.COMPLIB) as store:
+    for key, template in templates.items():
+      if template is None:
+        continue
+      decisions, dropped, resolved = merged[key]
+      for chunk in read_chunks(datafiles, key, template, force=force, chunksize=chunksize):
+        chunk = chunk[~chunk.index.isin(dropped)].copy()
+        if len(resolved) > 0:
+          chunk['digest'] = resolved.reindex(chunk.index).fillna(chunk['digest'])
+        chunk['should_remove'] = decisions['should_remove'].reindex(chunk.index, fill_value=REMOVAL_CODE_IGNORE)
+        chunk['persist_version'] = decisions['persist_version'].reindex(chunk.index, fill_value=PERSIST_VERSION_KEEP)
+        # Datafiles are always read as a whole: indexing the table would take more memory than the analysis
+        append_entries(store, key, chunk, index=False)
+    # After reading the datafiles, the working information needs to be sanitised and refreshed
+    store.put('info', storage.versioned(pd.DataFrame({'wd': ['.'], 'hostname': [hostname]})), format='table')
+
+def analyse(datafiles, datafilename, hostname, partitions, jobs=1, preferred_folder=False, select_folder=None, force=False, chunksize=CHUNK_SIZE):
+  '''
+  Deduplication of the entries of the datafiles partition by partition, writing the decisions to 'datafilename'
+  and the digest groups as manifests ('dedup_<label>.jsonl', see 'produce_dupes_scripts').
+  With no 'preferred_folder' (None), 'select_folder' is asked for it with the number of entries of every folder.
+  '''
+  with tempfile.TemporaryDirectory() as tempdir:
+    with profiling.stage('read'):
+      templates, folder_counts = partition_datafiles(datafiles, tempdir, partitions, force=force, chunksize=chunksize)
+    if preferred_folder is None:
+      preferred_folder = select_folder(folder_counts)
+
+    keys = [key for key, _ in TABLES if templates[key] is not None]
+    with profiling.stage('dedup'):
+      results = decide_partitions(tempdir, partitions, keys, jobs=jobs, preferred_folder=preferred_folder,
+                                  resolve=len(datafiles) > 1)
+
+    merged = {}
+    for key, label in TABLES:
+      if key not in results:
+        continue
+      parts = results[key]
+      merged[key] = (pd.concat([part['decisions'] for part in parts]),
+                     pd.Index([]).append([part['dropped'] for part in parts]),
+                     pd.concat([part['digests'] for part in parts]))
+      removed_size = bsize_value(sum(part['removed_size'] for part in parts))
+      print("{}================================ {} set".format(Fore.YELLOW, label))
+      print("entries: {} / duplicates: {} (groups: {}) / removing: {} ({:.2f} {})".format(
+              sum(part['entries'] for part in parts), sum(part['duplicates'] for part in parts),
+              sum(part['groups'] for part in parts), sum(part['removed'] for part in parts), *removed_size))
+      with profiling.stage('render'):
+        write_manifest(tempdir, partitions, key, label, hostname)
+
+    # The output might be one of the datafiles being read
+    with profiling.stage('hdf_write'):
+      output = os.path.join(tempdir, 'output.pho')
+      write_output(datafiles, output, templates, merged, hostname, force=force, chunksize=chunksize)
+      shutil.move(output, datafilename)
@@ -0,0 +1,108 @@
+# Stage profiling: wall and CPU time per stage, per-file latency histograms and counters,
+# written as a JSON report (and, for a chosen stage, as a cProfile dump).
+#
+# It is disabled unless 'enable' is called: stages are then not timed and counters are not updated.
+# Hot paths check 'profiling.enabled' before calling anything, so they pay a single attribute lookup.
+#
+# Worker processes keep their own metrics, which are returned to the parent with 'collect' and 'merge'.
+
+import os
+import sys
+import json
+import time
+import math
+import resource
+import cProfile
+import contextlib
+
+enabled = False
+cprofile_stage = None
+profiler = None
+
+stages = {}     # name -> [calls, wall seconds, cpu seconds]
+counters = {}   # name -> value
+histograms = {} # name -> {bucket: count}, buckets being powers of 2 of microseconds
+
+def enable(profile_stage=None):
+  ''' Starts gathering metrics (from scratch, as forked worker processes inherit those of their parent) '''
+  global enabled, cprofile_stage, profiler
+  collect()
+  enabled = True
+  cprofile_stage = profile_stage
+  profiler = cProfile.Profile() if profile_stage else None
+
+def start(name):
+  if name == cprofile_stage:
+    profiler.enable()
+  return time.perf_counter(), time.process_time()
+
+def stop(name, started, latency=False):
+  ''' Accounts the time since 'start' to the stage. With 'latency', it is also added to the stage histogram '''
+  wall = time.perf_counter() - started[0]
+  cpu = time.process_time() - started[1]
+  if name == cprofile_stage:
+    profiler.disable()
+  stage_times = stages.setdefault(name, [0, 0.0, 0.0])
+  stage_times[0] += 1
+  stage_times[1] += wall
+  stage_times[2] += cpu
+  if latency:
+    bucket = 2 ** max(0, math.ceil(math.log2(max(wall * 1e6, 1))))
+    histogram = histograms.setdefault(name, {})
+    histogram[bucket] = histogram.get(bucket, 0) + 1
+
+@contextlib.contextmanager
+def stage(name):
+  if not enabled:
+    yield
+    return
+  started = start(name)
+  try:
+    yield
+  finally:
+    stop(name, started)
+
+def count(name, value=1):
+  counters[name] = counters.get(name, 0) + value
+
+def collect():
+  ''' Returns the metrics gathered so far (by a worker process), and starts over '''
+  global stages, counters, histograms
+  metrics = {'stages': stages, 'counters': counters, 'histograms': histograms}
+  stages, counters, histograms = {}, {}, {}
+  return metrics
+
+def merge(metrics):
+  for name, (calls, wall, cpu) in metrics['stages'].items():
+    stage_times = stages.setdefault(name, [0, 0.0, 0.0])
+    stage_times[0] += calls
+    stage_times[1] += wall
+    stage_times[2] += cpu
+  for name, value in metrics['counters'].items():
+    count(name, value)
+  for name, histogram in metrics['histograms'].items():
+    for bucket, bucket_count in histogram.items():
+      histograms.setdefault(name, {})[bucket] = histograms.setdefault(name, {}).get(bucket, 0) + bucket_count
+
+def peak_memory():
+  ''' Peak resident memory (kB) of this process and of its (finished) worker processes '''
+  # 'ru_maxrss' is in bytes on macOS, and in kilobytes elsewhere
+  unit = 1024 if sys.platform == 'darwin' else 1
+  return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // unit,
+          'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // unit}
+
+def report():
+  hashing = stages.get('hash', [0, 0.0, 0.0])
+  return {
+    'stages': {name: {'calls': calls, 'wall': wall, 'cpu': cpu} for name, (calls, wall, cpu) in stages.items()},
+    'latency_us': {name: {str(bucket): histogram[bucket] for bucket in sorted(histogram)} for name, histogram in histograms.items()},
+    'counters': counters,
+    'hash_throughput_mbps': counters.get('bytes_hashed', 0) / hashing[1] / 1e6 if hashing[1] > 0 else None,
+    'peak_memory_kb': peak_memory(),
+  }
+
+def write_report(filename):
+  with open(filename, 'w') as f:
+    json.dump(report(), f, indent=2)
+  if profiler is not None:
+    profiler.dump_stats("{}.{}.prof".format(os.path.splitext(filename)[0], cprofile_stage))
@@ -0,0 +1,83 @@
+# Device-aware scheduling of the file identification: files are grouped by the device holding them ('st_dev'),
+# and each device has its own number of files in flight. Sources on different devices are then read at the
+# same time, while a spinning disk can still be read by a single sequential reader (no seek thrashing), and a
+# network mount by several (hiding its latency).
+#
+# Tasks are submitted one by one to the executor (no chunks), so a device never has more files in flight
+# than its limit. Results are yielded in the order of the tasks: those of a device ahead of the slowest one
+# are kept until its turn comes. Tasks can be read as they are needed (from a walk still going on), with a
+# bound on the tasks kept at a time, so memory doesn't grow with the number of files.
+
+import os
+import itertools
+import collections
+from concurrent.futures import wait, FIRST_COMPLETED
+
+def device_limits(device_jobs, devices, default=1):
+  ''' Files in flight for every device (in 'devices', as 'st_dev', and any other found later on).
+  'device_jobs' maps paths (any path on the device) to the limit of their device, other devices get 'default'.
+  '''
+  configured = {os.stat(path).st_dev: jobs for path, jobs in device_jobs.items()}
+  limits = collections.defaultdict(lambda: default)
+  limits.update({device: configured.get(device, default) for device in devices})
+  return limits
+
+def schedule(tasks, executor, function, limits, backlog=None):
+  ''' Yields 'function(task)' for every (folder, name, stats) task, in the same order as the tasks,
+  running them in the executor with no more than 'limits[st_dev]' tasks of a device at a time.
+  With 'backlog', no more than that many tasks are read from 'tasks' (any iterable) at a time: waiting, running,
+  or done and waiting for the results of the tasks before them.
+  '''
+  tasks = iter(tasks)
+  pending = {}
+  in_flight = {}
+  running = {}
+  results = {}
+  read, next_index = 0, 0
+
+  def submit(device):
+    while pending[device] and in_flight[device] < limits[device]:
+      index, task = pending[device].popleft()
+      running[executor.submit(function, task)] = (device, index)
+      in_flight[device] += 1
+
+  def read_tasks():
+    nonlocal read
+    devices = set()
+    for task in itertools.islice(tasks, None if backlog is None else max(0, backlog - (read - next_index))):
+      device = task[2].st_dev
+      pending.setdefault(device, collections.deque()).append((read, task))
+      in_flight.setdefault(device, 0)
+      devices.add(device)
+      read += 1
+    for device in devices:
+      submit(device)
+
+  read_tasks()
+  while running:
+    done, _ = wait(running, return_when=FIRST_COMPLETED)
+    for future in done:
+      device, index = running.pop(future)
+      in_flight[device] -= 1
+      results[index] = future.result()
+      submit(device)
+    while next_index in results:
+      yield results.pop(next_index)
+      next_index += 1
+    read_tasks()
+
+def bounded_map(executor, function, tasks, window, chunksize=1):
+  ''' Yields 'function(task)' for every task (any iterable), in order, as 'executor.map' does, but without
+  reading all the tasks upfront: they are submitted 'window' at a time, the next window before the results of
+  the current one are yielded (so workers are not left waiting)
+  '''
+  tasks = iter(tasks)
+  current = None
+  while True:
+    window_tasks = list(itertools.islice(tasks, window))
+    following = executor.map(function, window_tasks, chunksize=chunksize) if window_tasks else None
+    if current is not None:
+      yield from current
+    if following is None:
+      return
+    current = following
@@ -0,0 +1,129 @@
+# Near duplicates: re-encoded, resized or slightly edited copies of a picture, which have different digests.
+#
+# Pictures get a perceptual hash (a 64 bit difference hash, stored as 16 hexadecimal characters) while extracting,
+# and near duplicates are those within a small Hamming distance of each other. Pillow is needed to compute the hashes
+# (pip install photnon[similar]), not to search them.
+#
+# The search uses a multi-index: hashes are split in chunks of about log2(n) bits, and two hashes within distance 'd'
+# have at least one chunk within distance d // chunks (pigeonhole). Hashes are sorted by each chunk once, and candidate
+# pairs are those found in the buckets of every chunk value flipped by up to d // chunks bits, then checked on the full hash.
+# This is O(n log n) for the sorting, plus the candidates (about n per probed bucket for evenly spread hashes), without
+# ever comparing all pairs. Clusters are the connected components of the resulting pairs.
+
+import itertools
+
+import numpy as np
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+HASH_SIZE = 8 # 8x8 bits
+DEFAULT_DISTANCE = 6
+NO_HASH = '' # Pictures hashed without getting a hash, unlike those never hashed (missing)
+
+def available():
+  return Image is not None
+
+def perceptual_hash(data):
+  ''' Difference hash of the picture in 'data' (a file-like object, or a memory map), or NO_HASH if Pillow cannot read it.
+  Pictures too small or too flat to tell apart (which would all get the same hash) have none either.
+  '''
+  try:
+    with Image.open(data) as image:
+      if image.width <= HASH_SIZE or image.height < HASH_SIZE:
+        return NO_HASH
+      # JPEG pictures are decoded straight at a reduced scale
+      image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+      pixels = np.asarray(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS), dtype=np.int16)
+  except Exception:
+    return NO_HASH
+  if pixels.max() == pixels.min():
+    return NO_HASH
+  bits = np.packbits((pixels[:, 1:] > pixels[:, :-1]).flatten())
+  return bits.tobytes().hex()
+
+def hash_values(hashes):
+  ''' Hexadecimal hashes as unsigned 64 bit integers '''
+  return np.array([int(value, 16) for value in hashes], dtype=np.uint64)
+
+def hamming(left, right):
+  ''' Element-wise number of differing bits between two arrays of unsigned 64 bit integers '''
+  x = np.bitwise_xor(left, right)
+  x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+  x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+  x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+  return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+def flips(bits, distance):
+  ''' Masks of up to 'distance' bits set among 'bits' '''
+  return [sum(1 << bit for bit in combination) for flipped in range(distance + 1) for combination in itertools.combinations(range(bits), flipped)]
+
+def chunk_widths(count, distance):
+  ''' Bits of each chunk the hashes are split in: about log2(count) (so buckets hold about one hash each),
+  with at least 3 chunks (for bucket tables of up to 2^22 entries) and no more than needed to look up exact chunk values
+  '''
+  chunks = int(np.clip(round(64 / np.log2(max(count, 2))), 3, max(3, distance + 1)))
+  return [64 // chunks + (1 if chunk < 64 % chunks else 0) for chunk in range(chunks)]
+
+def near_pairs(values, distance=DEFAULT_DISTANCE):
+  ''' Pairs (i, j), i < j, of positions of 'values' (unsigned 64 bit integers) within Hamming 'distance' of each other '''
+  widths = chunk_widths(len(values), distance)
+  pairs = []
+  shift = 0
+  for width in widths:
+    keys = ((values >> np.uint64(shift)) & np.uint64(2**width - 1)).astype(np.int64)
+    shift += width
+    # Hashes sorted by chunk value, with the start of every bucket
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    bucket_starts = np.searchsorted(sorted_keys, np.arange(2**width + 1))
+
+    for mask in flips(width, distance // len(widths)):
+      # Every hash probes every mask, as the flipped bits can be split between both chunk values (01 and 10 are
+      # 2 bits apart): pairs are found from both ends, and only kept once
+      probes = keys[order] ^ mask
+      starts = bucket_starts[probes]
+      counts = bucket_starts[probes + 1] - starts
+      total = counts.sum()
+      if total == 0:
+        continue
+      left = np.repeat(order, counts)
+      right = order[np.arange(total) - np.repeat(np.cumsum(counts) - counts - starts, counts)]
+      candidates = left < right
+      left, right = left[candidates], right[candidates]
+      close = hamming(values[left], values[right]) <= distance
+      left, right = left[close], right[close]
+      pairs.append(left * len(values) + right)
+
+  if len(pairs) == 0:
+    return np.empty((0, 2), dtype=np.int64)
+  pairs = np.unique(np.concatenate(pairs))
+  return np.stack([pairs // len(values), pairs % len(values)], axis=1)
+
+def clusters(hashes, distance=DEFAULT_DISTANCE):
+  ''' Cluster label of every hash (the lowest position in its cluster), -1 for hashes without near duplicates '''
+  unique_hashes, inverse = np.unique(np.asarray(hashes, dtype=object), return_inverse=True)
+  values = hash_values(unique_hashes)
+  pairs = near_pairs(values, distance)
+
+  # Connected components, by propagating the lowest label through the pairs
+  labels = np.arange(len(values))
+  while len(pairs) > 0:
+    lowest = np.minimum(labels[pairs[:, 0]], labels[pairs[:, 1]])
+    updated = labels.copy()
+    np.minimum.at(updated, pairs[:, 0], lowest)
+    np.minimum.at(updated, pairs[:, 1], lowest)
+    updated = updated[updated]
+    if np.array_equal(updated, labels):
+      break
+    labels = updated
+
+  # Back to every hash, identical hashes being near duplicates as well
+  entry_labels = labels[inverse]
+  first_position = np.full(len(values), len(inverse))
+  np.minimum.at(first_position, entry_labels, np.arange(len(inverse)))
+  entry_labels = first_position[entry_labels]
+  sizes = np.bincount(entry_labels, minlength=len(inverse))
+  return np.where(sizes[entry_labels] > 1, entry_labels, -1)
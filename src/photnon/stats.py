@@ -0,0 +1,66 @@
+# Statistics behind the reports ('general_info', 'timed_info' and 'preduplication_info' in 'data_analysis').
+#
+# Every section is computed over numpy arrays in a single vectorized pass (masks are built once per section,
+# and counted with 'count_nonzero' instead of iterating over them), and returned as a dictionary of plain
+# numbers: the reports print it, and 'bin/photnon --stats' exports all of them as JSON.
+
+import numpy as np
+
+# Discrepancy buckets (seconds): <= 1 minute, <= 1 hour, <= 1 day and > 1 day
+DISCREPANCY_EDGES = [60, 3600, 24*3600]
+
+def count(mask):
+  return int(np.count_nonzero(mask))
+
+def share(part, total):
+  return part / total if total > 0 else None
+
+def discrepancy_buckets(seconds):
+  ''' Share of the discrepancies (in seconds) in every bucket of DISCREPANCY_EDGES '''
+  finite = seconds[np.isfinite(seconds)]
+  counts = np.bincount(np.searchsorted(DISCREPANCY_EDGES, finite, side='left'), minlength=len(DISCREPANCY_EDGES) + 1)
+  return [share(int(bucket_count), len(seconds)) for bucket_count in counts]
+
+def general_stats(ph_ok, ph_error):
+  num_ok = len(ph_ok)
+  num_error = len(ph_error)
+  json_ok = count(ph_ok['has_json'].to_numpy(dtype=bool))
+  json_error = count(ph_error['has_json'].to_numpy(dtype=bool))
+  return {'total': num_ok + num_error,
+          'ok': num_ok,
+          'error': num_error,
+          'errors': share(num_error, num_ok + num_error),
+          'with_json': share(json_ok + json_error, num_ok + num_error),
+          'with_json_ok': json_ok}
+
+def timed_stats(photos_df_timed):
+  ''' Needs the columns added by 'enrich' ('second_discrepancy') '''
+  num_photos = len(photos_df_timed)
+  mtime = photos_df_timed['mtime'].to_numpy(dtype='datetime64[ns]')
+  datetime = photos_df_timed['datetime'].to_numpy(dtype='datetime64[ns]')
+  discrepancy = photos_df_timed['second_discrepancy'].to_numpy(dtype=float)
+  timeless = photos_df_timed['timeless'].fillna(False).to_numpy(dtype=bool) if 'timeless' in photos_df_timed.columns else np.zeros(num_photos, dtype=bool)
+  discrepant = discrepancy != 0
+
+  return {'photos': num_photos,
+          'matching_times': share(count(mtime == datetime), num_photos),
+          'matching_dates': share(count(mtime.astype('datetime64[D]') == datetime.astype('datetime64[D]')), num_photos),
+          'discrepant': count(discrepant),
+          'discrepancy': discrepancy_buckets(discrepancy[discrepant]),
+          'timeless': share(count(timeless), num_photos),
+          'timeless_photos': count(timeless),
+          'timeless_discrepancy': discrepancy_buckets(discrepancy[timeless])}
+
+def duplication_stats(photos_df, dup_full, dup_full_except_first, dup_digest, dup_digest_except_first):
+  ''' Entries (and bytes) kept, removed and processed by each kind of duplication '''
+  sizes = photos_df['size'].to_numpy(dtype='int64') if 'size' in photos_df else None
+  stats = {'photos': len(photos_df), 'size': int(sizes.sum()) if sizes is not None else None}
+  for kind, duplicated, except_first in [('full', dup_full, dup_full_except_first), ('digest', dup_digest, dup_digest_except_first)]:
+    duplicated = np.asarray(duplicated, dtype=bool)
+    removed = np.asarray(except_first, dtype=bool)
+    stats[kind] = {'kept': count(~removed), 'removed': count(removed), 'processed': count(duplicated)}
+    if sizes is not None:
+      removed_size = int(sizes[removed].sum())
+      stats[kind].update({'kept_size': stats['size'] - removed_size, 'removed_size': removed_size,
+                          'processed_size': int(sizes[duplicated].sum())})
+  return stats
@@ -1,4 +1,36 @@
+# Datafile layout. The schema version is recorded in the 'info' table:
+#   1: (no 'schema' column) uncompressed tables, all string columns as objects
+#   2: compressed tables, low-cardinality string columns stored as categoricals
+#   3: 'phash' column (perceptual hash, see 'similarity'), missing unless extracted with it, empty for pictures without one
+# Every version is read the same way, the entries being made compact in memory once loaded.
+
+SCHEMA_VERSION = 3
+CATEGORICAL_COLUMNS = ['folder', 'make', 'model', 'mime']
+COMPLEVEL = 5
+COMPLIB = 'blosc'
+
 def normalize(name):
   if name[-4:] == '.pho':
     name = name[:-4]
   return "{}.pho".format(name)
+
+def compact(entries):
+  ''' Turns the low-cardinality string columns into categoricals (with lexically sorted categories) '''
+  for column in CATEGORICAL_COLUMNS:
+    if column in entries.columns and entries[column].dtype == object:
+      entries[column] = entries[column].astype('category')
+  return entries
+
+def write_table(entries, datafilename, key):
+  compact(entries.copy()).to_hdf(datafilename, key=key, format="table", complevel=COMPLEVEL, complib=COMPLIB)
+
+def versioned(info):
+  ''' The 'info' table to write, recording the schema version '''
+  info = info.copy()
+  info['schema'] = SCHEMA_VERSION
+  return info
+
+def schema_version(info):
+  if info is None or 'schema' not in info.columns:
+    return 1
+  return int(info['schema'].iloc[0])
@@ -1,3 +1,3 @@
-{% for i, item in entries.iterrows() -%}
-touch -m -t {{ item.datetime|datetimeformat("%Y%m%d%H%M.%S") }} "{{ item.fullpath }}"
+{% for timestamp, fullpath in entries -%}
+touch -m -t {{ timestamp }} "{{ fullpath }}"
 {% endfor %}
\ No newline at end of file
@@ -0,0 +1,404 @@
+# Watch mode: keeps a datafile up to date with the files of some folders as they change (Linux only).
+#
+# Folders are watched with inotify (through ctypes, so nothing else is needed). Events are gathered until the folders
+# have been quiet for a while (or for too long, see 'DEBOUNCE' and 'MAX_DELAY'), and applied to the datafile at once:
+# - files written (closed after writing) or moved in are identified, replacing their previous entry
+# - files deleted or moved out have their entry dropped
+# - files renamed (moved within the watched folders) keep their entry: the digest is carried over to the new path
+#   without reading the file again, and only the times and inode are refreshed
+# - files whose metadata changed (i.e. their mtime, as the retime scripts do) only have their times refreshed
+# Folders created, deleted, moved or renamed are handled the same way, for all the files under them.
+#
+# Watching starts with an incremental extraction (see 'extract_data'), so changes made while not watching are picked
+# up as well. If the kernel event queue overflows, events are lost and the sources are extracted (incrementally) again.
+
+import os
+import glob
+import time
+import errno
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from datetime import datetime as dt
+
+import pandas as pd
+from colorama import Fore
+
+from photnon import storage
+from photnon import profiling
+from photnon.data_extraction import extract_data, finalize_entries, identify_task, info_frame, scan
+from photnon.data_extraction import IGNORED_FOLDERS_REGEX, IGNORED_FILES_REGEX
+from photnon.data_analysis import fullpaths
+
+DEBOUNCE = 2.0 # seconds without events before applying them
+MAX_DELAY = 30.0 # seconds after the first event of a batch, for folders which never get quiet
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len (followed by the name, padded with NULs)
+READ_SIZE = 2**16
+
+STAT_COLUMNS = ['atime', 'mtime', 'ctime', 'inode']
+
+class Inotify:
+  ''' Minimal inotify binding: folders are watched with 'watch', and 'read' returns (folder, name, mask, cookie) events '''
+
+  def __init__(self):
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self._add_watch = libc.inotify_add_watch
+    self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    self._rm_watch = libc.inotify_rm_watch
+    self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    self.folders = {} # watch descriptor -> folder
+
+  def watch(self, folder):
+    wd = self._add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+    if wd < 0:
+      error = ctypes.get_errno()
+      if error == errno.ENOSPC:
+        raise OSError(error, "too many folders to watch (see /proc/sys/fs/inotify/max_user_watches)", folder)
+      # The folder might be gone already
+      if error not in (errno.ENOENT, errno.ENOTDIR):
+        raise OSError(error, os.strerror(error), folder)
+      return
+    self.folders[wd] = folder
+
+  def watch_tree(self, folder):
+    ''' Watches 'folder' and every folder under it, skipping ignored folders (as 'scan' does) '''
+    self.watch(folder)
+    for parent, subfolders, _ in os.walk(folder):
+      subfolders[:] = [f for f in subfolders if not IGNORED_FOLDERS_REGEX.match(f) and not os.path.islink(os.path.join(parent, f))]
+      for subfolder in subfolders:
+        self.watch(os.path.join(parent, subfolder))
+
+  def forget(self, folder):
+    ''' Stops watching 'folder' and the folders under it (moved out of the watched folders) '''
+    for wd, watched in list(self.folders.items()):
+      if under(watched, folder):
+        self._rm_watch(self.fd, wd)
+        del self.folders[wd]
+
+  def rename(self, old, new):
+    ''' Watches follow the folders they were added to: only their paths change '''
+    for wd, watched in self.folders.items():
+      if under(watched, old):
+        self.folders[wd] = new + watched[len(old):]
+
+  def read(self, timeout=None):
+    ''' Events available within 'timeout' seconds (blocking if None), as (folder, name, mask, cookie) '''
+    ready, _, _ = select.select([self.fd], [], [], timeout)
+    if not ready:
+      return []
+    events = []
+    while True:
+      try:
+        buffer = os.read(self.fd, READ_SIZE)
+      except BlockingIOError:
+        break
+      offset = 0
+      while offset < len(buffer):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+        name = os.fsdecode(buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+        offset += EVENT_HEADER.size + length
+        if mask & IN_IGNORED:
+          self.folders.pop(wd, None)
+        elif mask & IN_Q_OVERFLOW or wd in self.folders:
+          events.append((self.folders.get(wd), name, mask, cookie))
+    return events
+
+  def close(self):
+    os.close(self.fd)
+
+def under(path, folder):
+  return path == folder or path.startswith(folder + os.path.sep)
+
+def moved(path, old, new):
+  return new + path[len(old):] if under(path, old) else path
+
+class Batch:
+  ''' Changes gathered from the events, to be applied at once (see 'apply') '''
+
+  def __init__(self):
+    self.started = None
+    self.dirty = {}          # paths to identify again (or to drop, if they no longer exist), in order
+    self.touched = set()     # paths whose times (only) changed
+    self.sidecars = set()    # paths whose JSON metadata file was added or removed
+    self.renames = []        # (old path, new path, is folder), in order
+    self.new_folders = []    # folders created or moved in, to scan
+    self.gone_folders = []   # folders deleted or moved out
+    self.moved_from = {}     # cookie -> (path, is folder) until the matching 'moved to' shows up
+    self.rescan = False
+
+  def __len__(self):
+    return len(self.dirty) + len(self.touched) + len(self.sidecars) + len(self.renames) + len(self.new_folders) + \
+           len(self.gone_folders) + len(self.moved_from) + self.rescan
+
+  def rename(self, old, new, is_folder):
+    ''' Pending changes follow renamed paths '''
+    self.renames.append((old, new, is_folder))
+    self.dirty = {moved(path, old, new): True for path in self.dirty}
+    self.touched = {moved(path, old, new) for path in self.touched}
+    self.sidecars = {moved(path, old, new) for path in self.sidecars}
+    self.new_folders = [moved(folder, old, new) for folder in self.new_folders]
+    if not is_folder:
+      self.touched.add(new)
+
+def record(batch, inotify, event):
+  ''' Adds an inotify event to the batch. Watches are updated right away, as the next events depend on them '''
+  folder, name, mask, cookie = event
+  if batch.started is None:
+    batch.started = time.monotonic()
+  if mask & IN_Q_OVERFLOW:
+    batch.rescan = True
+    return
+  path = os.path.join(folder, name)
+
+  if mask & IN_ISDIR:
+    if IGNORED_FOLDERS_REGEX.match(name):
+      return
+    if mask & IN_CREATE:
+      inotify.watch_tree(path)
+      batch.new_folders.append(path)
+    elif mask & IN_DELETE:
+      batch.gone_folders.append(path)
+    elif mask & IN_MOVED_FROM:
+      batch.moved_from[cookie] = (path, True)
+    elif mask & IN_MOVED_TO:
+      if cookie in batch.moved_from:
+        old, _ = batch.moved_from.pop(cookie)
+        inotify.rename(old, path)
+        batch.rename(old, path, True)
+      else:
+        inotify.watch_tree(path)
+        batch.new_folders.append(path)
+    return
+
+  if IGNORED_FILES_REGEX.match(name):
+    if name.endswith('.json') and mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+      batch.sidecars.add(path[:-len('.json')])
+    return
+  if mask & IN_MOVED_FROM:
+    batch.moved_from[cookie] = (path, False)
+  elif mask & IN_MOVED_TO and cookie in batch.moved_from:
+    old, _ = batch.moved_from.pop(cookie)
+    batch.rename(old, path, False)
+  elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE):
+    batch.dirty[path] = True
+  elif mask & IN_ATTRIB:
+    batch.touched.add(path)
+
+def load_tables(datafilename):
+  ''' The 'ok' and 'error' entries of the datafile, with plain strings (they are compacted again when written) '''
+  tables = {'ok': pd.DataFrame(), 'error': pd.DataFrame()}
+  if os.path.isfile(datafilename):
+    with pd.HDFStore(datafilename, mode='r') as store:
+      for key in tables:
+        if '/{}'.format(key) in store:
+          table = store[key]
+          tables[key] = table.astype({column: object for column in table.columns[table.dtypes == 'category']})
+  return tables
+
+def write_tables(tables, datafilename, working_info):
+  ''' Rewritten as a whole (HDF files do not reclaim the space of replaced tables), replacing the datafile at once '''
+  temporary = "{}.tmp".format(datafilename)
+  with profiling.stage('hdf_write'):
+    storage.write_table(tables['ok'], temporary, 'ok')
+    storage.write_table(tables['error'], temporary, 'error')
+    storage.versioned(info_frame(working_info)).to_hdf(temporary, key='info', format="table")
+  os.replace(temporary, datafilename)
+
+def identify_path(task, **options):
+  ''' 'identify_task', for files which might be gone by the time they are identified '''
+  try:
+    return identify_task(task, **options)
+  except OSError:
+    return None
+
+def stat_values(stats):
+  return [dt.fromtimestamp(stats.st_atime), dt.fromtimestamp(stats.st_mtime), dt.fromtimestamp(stats.st_ctime), stats.st_ino]
+
+def apply(batch, tables, executor=None, verbose=0, **options):
+  ''' Applies the batch to the tables, returning the number of entries identified, renamed, removed and refreshed '''
+  counts = {'identified': 0, 'renamed': 0, 'removed': 0, 'refreshed': 0}
+  paths = {key: fullpaths(table) if len(table) > 0 else pd.Series(dtype=object) for key, table in tables.items()}
+
+  def drop(mask_of, removed=True):
+    for key, table in tables.items():
+      if len(table) > 0:
+        mask = mask_of(key, table)
+        if removed: counts['removed'] += int(mask.sum())
+        tables[key], paths[key] = table[~mask].copy(), paths[key][~mask]
+
+  # Whatever was moved out of the watched folders is gone
+  for path, is_folder in batch.moved_from.values():
+    if is_folder:
+      batch.gone_folders.append(path)
+    else:
+      batch.dirty[path] = True
+
+  for old, new, is_folder in batch.renames:
+    if not is_folder:
+      # A file renamed over another one replaces it
+      drop(lambda key, table: paths[key] == new, removed=False)
+    for key, table in tables.items():
+      if len(table) == 0:
+        continue
+      if is_folder:
+        mask = (table['folder'] == old) | table['folder'].str.startswith(old + os.path.sep)
+        table.loc[mask, 'folder'] = new + table.loc[mask, 'folder'].str[len(old):]
+      else:
+        mask = paths[key] == old
+        table.loc[mask, ['folder', 'name']] = os.path.split(new)
+      paths[key][mask] = fullpaths(table.loc[mask])
+      counts['renamed'] += int(mask.sum())
+    if not is_folder and not any((paths[key] == new).any() for key in tables):
+      batch.dirty[new] = True
+    if verbose: print("{} -> {}".format(old, new))
+
+  for folder in batch.gone_folders:
+    drop(lambda key, table: (table['folder'] == folder) | table['folder'].str.startswith(folder + os.path.sep))
+  for folder in batch.new_folders:
+    for p, file, _ in (scan(folder) if os.path.isdir(folder) else []):
+      batch.dirty[os.path.join(p, file)] = True
+
+  # Times only: unless the size changed too
+  refreshed = {}
+  for path in batch.touched - set(batch.dirty):
+    try:
+      stats = os.stat(path)
+    except OSError:
+      batch.dirty[path] = True
+      continue
+    for key, table in tables.items():
+      mask = paths[key] == path
+      if mask.any():
+        if (table.loc[mask, 'size'] != stats.st_size).any():
+          batch.dirty[path] = True
+        else:
+          refreshed.setdefault(key, []).append((mask, stat_values(stats)))
+  for key, updates in refreshed.items():
+    columns = [column for column in STAT_COLUMNS if column in tables[key].columns]
+    for mask, values in updates:
+      tables[key].loc[mask, columns] = values[:len(columns)]
+      counts['refreshed'] += int(mask.sum())
+
+  # Written, created or deleted files: their previous entries are replaced
+  tasks = []
+  for path in batch.dirty:
+    try:
+      if os.path.isfile(path):
+        tasks.append((*os.path.split(path), os.stat(path)))
+    except OSError:
+      pass
+  identify = partial(identify_path, **options)
+  results = executor.map(identify, tasks) if executor is not None else map(identify, tasks)
+  data = []
+  for (folder, name, _), result in zip(tasks, results):
+    if result is None:
+      continue
+    (datetime, make, model, digest, mime, code, size, atime, mtime, ctime, has_json, inode, perceptual_hash), _, metrics = result
+    if metrics: profiling.merge(metrics)
+    if code is None:
+      continue
+    data.append([folder, name, datetime, make, model, digest, mime, code, size, atime, mtime, ctime, has_json, inode, perceptual_hash])
+    if verbose: print("{}{}{}".format(Fore.GREEN, os.path.join(folder, name), Fore.RESET))
+  replaced = set(batch.dirty)
+  identified = {os.path.join(folder, name) for folder, name, *_ in data}
+  drop(lambda key, table: paths[key].isin(replaced - identified))
+  drop(lambda key, table: paths[key].isin(identified), removed=False)
+  counts['identified'] = len(data)
+
+  if len(data) > 0:
+    first_index = max([table.index.max() + 1 for table in tables.values() if len(table) > 0], default=0)
+    for key, ph_new in zip(['ok', 'error'], finalize_entries(data, first_index=first_index)):
+      # Empty frames are left out of the concatenation, as they would turn typed columns into 'object'
+      if len(ph_new) > 0:
+        tables[key] = pd.concat([tables[key], ph_new]) if len(tables[key]) > 0 else ph_new
+        paths[key] = fullpaths(tables[key])
+
+  for path in batch.sidecars - replaced:
+    for key, table in tables.items():
+      mask = paths[key] == path
+      if mask.any():
+        table.loc[mask, 'has_json'] = os.path.exists(path + '.json')
+        counts['refreshed'] += int(mask.sum())
+  return counts
+
+def interrupt(signum, frame):
+  raise KeyboardInterrupt
+
+def watch(space, datafile, working_info, verbose=0, jobs=1, debounce=DEBOUNCE, metadata_only=False, phash=False):
+  ''' Watches the folders of 'space' (files, folders or patterns, as for an extraction), keeping 'datafile' up to date
+  until interrupted (Ctrl+C, or SIGTERM when run as a service). 'jobs' processes identify the files of every batch.
+  '''
+  datafilename = storage.normalize(datafile)
+  folders = [path for source in (space if type(space) is list else [space]) for path in glob.iglob(source) if os.path.isdir(path)]
+  if len(folders) == 0:
+    print("{}Nothing to watch: only folders can be watched{}".format(Fore.RED, Fore.RESET))
+    return
+
+  signal.signal(signal.SIGTERM, interrupt)
+  inotify = Inotify()
+  executor = ProcessPoolExecutor(max_workers=jobs, initializer=profiling.enable if profiling.enabled else None) if jobs > 1 else None
+  options = {'hashing': True, 'metadata_only': metadata_only, 'phash': phash}
+  try:
+    # Watching starts before the extraction: changes made meanwhile are applied afterwards
+    for folder in folders:
+      inotify.watch_tree(folder)
+    extract_data(folders, datafilename, working_info=working_info, verbose=verbose, jobs=jobs, incremental=True, metadata_only=metadata_only, phash=phash)
+    tables = load_tables(datafilename)
+    print("{}watching {} folders{} (Ctrl+C to stop)".format(Fore.GREEN, len(inotify.folders), Fore.RESET))
+
+    batch = Batch()
+    try:
+      while True:
+        timeout = None
+        if len(batch) > 0:
+          timeout = max(0, min(debounce, batch.started + MAX_DELAY - time.monotonic()))
+        events = inotify.read(timeout)
+        for event in events:
+          record(batch, inotify, event)
+        if len(events) > 0 and time.monotonic() - batch.started < MAX_DELAY:
+          continue
+
+        if len(batch) == 0:
+          pass
+        elif batch.rescan:
+          print("{}events were lost: extracting again{}".format(Fore.YELLOW, Fore.RESET))
+          extract_data(folders, datafilename, working_info=working_info, verbose=verbose, jobs=jobs, incremental=True, metadata_only=metadata_only, phash=phash)
+          tables = load_tables(datafilename)
+        else:
+          for path, is_folder in batch.moved_from.values():
+            if is_folder: inotify.forget(path)
+          counts = apply(batch, tables, executor, verbose=verbose, **options)
+          write_tables(tables, datafilename, working_info)
+          print("{:%H:%M:%S} {} identified, {} renamed, {} removed, {} refreshed ({} ok / {} error)".format(
+                  dt.now(), counts['identified'], counts['renamed'], counts['removed'], counts['refreshed'],
+                  len(tables['ok']), len(tables['error'])))
+        batch = Batch()
+    except KeyboardInterrupt:
+      if len(batch) > 0 and not batch.rescan:
+        apply(batch, tables, executor, verbose=verbose, **options)
+        write_tables(tables, datafilename, working_info)
+      print("{}stopped watching{}".format(Fore.GREEN, Fore.RESET))
+  finally:
+    inotify.close()
+    if executor is not None:
+      executor.shutdown()
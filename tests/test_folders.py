@@ -0,0 +1,71 @@
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from photnon.folders import collapsed_folder_counts
+
+def all_folders_with_counts(folders):
+  ''' The previous level-by-level aggregation with DataFrame queries ('Series.append' replaced by 'pd.concat') '''
+  folder_counts = folders.value_counts()
+  folder_tokens = [folder_count.split(os.path.sep) for folder_count in folder_counts.index.values]
+  folder_tokens_counts = pd.concat([pd.DataFrame(folder_tokens, index=folder_counts.index), folder_counts.to_frame()], axis=1)
+
+  file_counts = pd.Series(dtype='int64')
+  last_level_counts = None
+  for top in range(1, len(folder_tokens_counts.columns)-1):
+    positions = list(folder_tokens_counts.columns[:-top].values)
+    folder_tokens_counts_aggregated = folder_tokens_counts.loc[~folder_tokens_counts[positions[-1]].isna()].fillna('').groupby(positions, axis=0).sum()
+
+    if last_level_counts is not None:
+      for new_level_index in folder_tokens_counts_aggregated.index:
+        if new_level_index in last_level_counts.index:
+          if len(last_level_counts.loc[new_level_index, :]) == 1:
+            folder_tokens_counts_aggregated.drop(new_level_index, axis=0, inplace=True)
+            subqueries = []
+            for i in positions:
+              subqueries.append("(@new_level_index[{0}] == @folder_tokens_counts[{0}])".format(i))
+            query = " & ".join(subqueries)
+            folder_tokens_counts.drop(folder_tokens_counts.query(query).index, inplace=True)
+
+      if len(folder_tokens_counts_aggregated) == 0:
+        break
+    last_level_counts = folder_tokens_counts_aggregated.copy()
+    file_counts = pd.concat([file_counts, folder_tokens_counts_aggregated['folder']])
+
+  return file_counts.sort_values(ascending=False)
+
+def legacy_counts(folders):
+  with warnings.catch_warnings():
+    # The previous implementation relies on deprecated pandas (and numpy) behaviour
+    warnings.simplefilter('ignore', FutureWarning)
+    warnings.simplefilter('ignore', DeprecationWarning)
+    counts = all_folders_with_counts(folders)
+  return counts.set_axis(counts.index.map(lambda ix: os.path.sep.join(ix)))
+
+def synthetic_folders(folders, seed=0):
+  ''' Files of a random folder tree, with a few long single-child chains and files at every depth '''
+  rng = np.random.default_rng(seed)
+  paths = ['/photos']
+  for _ in range(folders - 1):
+    parent = paths[rng.integers(0, len(paths))]
+    chain = 1 if rng.random() < 0.8 else rng.integers(2, 4)
+    for _ in range(chain):
+      parent = "{}/{}".format(parent, rng.choice(['2019', '2020', 'album', 'raw', 'edits', 'trip']) + str(rng.integers(0, 5)))
+    paths.append(parent)
+  paths = sorted(set(paths))
+  files = rng.integers(1, 20, size=len(paths))
+  return pd.Series(np.repeat(paths, files), name='folder')
+
+@pytest.mark.parametrize('size, seed', [(30, seed) for seed in range(20)] + [(100, seed) for seed in range(2)])
+def test_counts_match_level_aggregation(size, seed):
+  folders = synthetic_folders(size, seed=seed)
+  pd.testing.assert_series_equal(collapsed_folder_counts(folders).sort_index(), legacy_counts(folders).sort_index(),
+                                 check_names=False, check_index_type=False)
+
+def test_single_child_chains_are_collapsed():
+  folders = pd.Series(['/photos/2019/trip'] * 3 + ['/photos/2019/trip/raw'] * 2 + ['/photos/2020'] * 4, name='folder')
+  pd.testing.assert_series_equal(collapsed_folder_counts(folders).sort_index(), legacy_counts(folders).sort_index(),
+                                 check_names=False, check_index_type=False)
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from photnon import similarity
+
+def brute_force_pairs(values, distance):
+  left, right = np.triu_indices(len(values), k=1)
+  close = similarity.hamming(values[left], values[right]) <= distance
+  return np.stack([left[close], right[close]], axis=1)
+
+def random_values(count, near, seed, distance=0):
+  ''' Random hashes, 'near' of them being copies of others with up to 'distance' bits flipped '''
+  rng = np.random.default_rng(seed)
+  values = rng.integers(0, 2**64, size=count, dtype=np.uint64)
+  copies = rng.choice(count, size=near, replace=False)
+  for copy in copies:
+    flipped = rng.choice(64, size=rng.integers(1, distance + 1), replace=False)
+    values[copy] = values[rng.integers(count)] ^ np.uint64(sum(1 << int(bit) for bit in flipped))
+  return values
+
+@pytest.mark.parametrize('count, distance', [(500, 2), (2000, 6), (2000, 15), (3000, 10)])
+def test_near_pairs_match_brute_force(count, distance):
+  values = random_values(count, count // 4, seed=count + distance, distance=distance)
+  np.testing.assert_array_equal(similarity.near_pairs(values, distance), brute_force_pairs(values, distance))
+
+def test_near_pairs_with_bits_split_between_hashes():
+  # Several chunks, and flips of 2 bits: copies differ in 2 bits of every chunk, one set in each hash
+  count, distance = 2000, 15
+  widths = similarity.chunk_widths(count, distance)
+  assert len(widths) > 1 and distance // len(widths) >= 2
+  rng = np.random.default_rng(0)
+  values = random_values(count, 0, seed=0)
+  for original, copy in rng.choice(count, size=(100, 2), replace=False):
+    ones, others = 0, 0
+    for start, width in zip(np.cumsum([0] + widths[:-1]), widths):
+      one, other = rng.choice(width, size=2, replace=False)
+      ones |= 1 << int(start + one)
+      others |= 1 << int(start + other)
+    values[original] = (values[original] | np.uint64(ones)) & ~np.uint64(others)
+    values[copy] = values[original] ^ np.uint64(ones | others)
+  expected = brute_force_pairs(values, distance)
+  assert len(expected) >= 100
+  np.testing.assert_array_equal(similarity.near_pairs(values, distance), expected)
+
+def test_fill_perceptual_hashes_only_reads_pictures_never_hashed(tmp_path, capsys):
+  data_extraction = pytest.importorskip('photnon.data_extraction')
+  photos = pd.DataFrame({'folder': str(tmp_path), 'name': ['hashed.jpg', 'without_hash.jpg', 'missing.jpg', 'notes.txt'],
+                         'mime': ['image/jpeg', 'image/jpeg', 'image/jpeg', 'text/plain'],
+                         'phash': ['66799a2a6e293251', similarity.NO_HASH, None, None]})
+  # None of the files exist: only the picture never hashed is read, and cannot be
+  hashes = data_extraction.fill_perceptual_hashes(photos)
+  assert hashes.tolist() == ['66799a2a6e293251', similarity.NO_HASH, None, None]
+  assert 'missing.jpg' in capsys.readouterr().out